@@ -1,22 +1,678 @@
+import hashlib
+import json
 import logging
+import os
 import re
 import signal
 import socket
-
-from http_commons import nlc, to_bytes
-
-max_buffer_size = 1024
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import BinaryIO, Iterator
+
+from http_commons import enable_fast_open_connect, nlc, to_bytes, tune_socket
+
+initial_buffer_size = 16 * 1024
+receive_buffer_size = 256 * 1024
+max_response_head_size = 64 * 1024
+max_connections_per_host = 8
+idle_connection_timeout = 30.0
+request_timeout = 30.0
+download_segment_size = 8 * 1024 * 1024
+download_parallelism = 4
+tcp_fast_open = False
+socket_send_buffer = None
+socket_receive_buffer = None
+response_cache_size = 64 * 1024 * 1024
+idempotent_methods = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+hop_by_hop_headers = ("connection", "keep-alive", "transfer-encoding")
 
 # logging.basicConfig(level=logging.DEBUG)
 
 bnlc = nlc.encode()
 
 
+class IncompleteResponse(Exception):
+    """The connection was closed before the whole response was received"""
+
+
+class Response:
+    """Status line, headers and body of a received HTTP response"""
+
+    def __init__(self, version: str, status: int, reason: str, headers: dict[str, str], body: bytes):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.head_size = 0
+        self.chunks = None
+        self.reader = None
+        self.persistent = False
+        self.reusable = False
+        self.on_close = None
+        self.from_cache = False
+
+    def __enter__(self) -> "Response":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def header(self, name: str, default: str | None = None) -> str | None:
+        """Case insensitive lookup of a response header"""
+        return find_header(self.headers, name, default)
+
+    def text(self) -> str:
+        """Body decoded with the charset of the Content-Type header"""
+        return self.body.decode(extract_encoding(self.header("Content-Type", "")))
+
+    def iter_content(self) -> Iterator[memoryview]:
+        """Body chunks as they are received, each one is only valid until the next one is requested"""
+        if self.chunks is None:
+            if self.body:
+                yield memoryview(self.body)
+            return
+        complete = False
+        try:
+            yield from self.chunks
+            self.completed()
+            complete = True
+        finally:
+            self.chunks = None
+            self.finish(complete)
+
+    def write_to(self, file: BinaryIO) -> int:
+        """Stream the body into a file and return the number of bytes written"""
+        written = 0
+        for chunk in self.iter_content():
+            file.write(chunk)
+            written += len(chunk)
+        return written
+
+    def close(self) -> None:
+        """Stop receiving a streamed body, its connection is closed unless the body was read completely"""
+        if self.chunks is not None:
+            self.chunks = None
+            self.finish(False)
+
+    def completed(self) -> None:
+        """Note that the body was received completely, so the connection may carry another request"""
+        self.reusable = self.persistent and not self.reader.available()
+        self.reader = None
+
+    def finish(self, complete: bool) -> None:
+        """Hand the connection back once the body is done with"""
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close(complete and self.reusable)
+
+    __del__ = close
+
+
+class ResponseReader:
+    """Buffered reads of a response from a socket, received with recv_into into one reusable buffer"""
+
+    def __init__(self, sock: socket.socket, size: int = initial_buffer_size):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def available(self) -> int:
+        """Number of received bytes not taken yet"""
+        return self.end - self.start
+
+    def fill(self) -> None:
+        """Receive more data after the buffered data, the response must not end here"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            if self.start == 0:
+                if len(self.buffer) >= max_response_head_size:
+                    raise ValueError("Response line or head too large")
+                self.resize(len(self.buffer) * 2)
+            else:
+                self.resize(len(self.buffer))
+        received = self.sock.recv_into(self.view[self.end:])
+        if not received:
+            raise IncompleteResponse("Connection closed before the whole response was received")
+        self.end += received
+
+    def resize(self, size: int) -> None:
+        """Move the buffered data to the front of a new buffer, views handed out before stay valid"""
+        available = self.available()
+        buffer = bytearray(size)
+        buffer[:available] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start, self.end = 0, available
+
+    def reserve(self, size: int) -> None:
+        """Grow the buffer for bodies larger than it"""
+        if len(self.buffer) < min(size, receive_buffer_size):
+            self.resize(receive_buffer_size)
+
+    def find(self, separator: bytes) -> int:
+        """Position of a separator after the buffered data start, receiving more data until it is found"""
+        searched = self.start
+        while (position := self.buffer.find(separator, searched, self.end)) < 0:
+            searched = max(self.end - len(separator) + 1, self.start)
+            offset = self.start
+            self.fill()
+            searched -= offset - self.start
+        return position
+
+    def read_line(self) -> bytes:
+        """Take one line without its line ending"""
+        line_end = self.find(bnlc)
+        line = bytes(self.view[self.start:line_end])
+        self.start = line_end + 2
+        return line
+
+    def take(self, size: int) -> memoryview:
+        """Take up to size bytes, receiving only when nothing is buffered"""
+        if self.start == self.end:
+            self.fill()
+        size = min(size, self.end - self.start)
+        view = self.view[self.start:self.start + size]
+        self.start += size
+        return view
+
+
+class ConnectionPool:
+    """Persistent connections per host, bounded per host and closed once idle for too long"""
+
+    def __init__(self, max_per_host: int, idle_timeout: float, timeout: float):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle = {}
+        self.open = {}
+        self.condition = threading.Condition()
+
+    def acquire(self, host: str, port: int) -> (socket.socket, bool):
+        """Return an idle connection to the host or open a new one, and whether it was reused"""
+        key = (host, port)
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while True:
+                self.evict_idle(time.monotonic())
+                idle = self.idle.get(key)
+                while idle:
+                    sock, _ = idle.pop()
+                    if is_connection_alive(sock):
+                        return sock, True
+                    self.discard(key, sock)
+                if self.open.get(key, 0) < self.max_per_host:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No connection to {host}:{port} became available")
+                self.condition.wait(remaining)
+        try:
+            return open_connection(host, port, self.timeout), False
+        except OSError:
+            with self.condition:
+                self.open[key] -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, host: str, port: int, sock: socket.socket, reusable: bool) -> None:
+        """Return a connection to the pool, or close it if it can not carry another request"""
+        key = (host, port)
+        with self.condition:
+            if reusable:
+                self.idle.setdefault(key, []).append((sock, time.monotonic()))
+            else:
+                self.discard(key, sock)
+            self.condition.notify()
+
+    def evict_idle(self, now: float) -> None:
+        """Close connections idle for longer than the idle timeout, the lock must be held"""
+        for key, idle in self.idle.items():
+            while idle and now - idle[0][1] >= self.idle_timeout:
+                sock, _ = idle.pop(0)
+                logging.debug(f"Closing idle connection to {key[0]}:{key[1]}")
+                self.discard(key, sock)
+
+    def discard(self, key: (str, int), sock: socket.socket) -> None:
+        """Close a connection and free its slot, the lock must be held"""
+        sock.close()
+        self.open[key] -= 1
+
+    def close(self) -> None:
+        """Close all idle connections"""
+        with self.condition:
+            for key, idle in self.idle.items():
+                for sock, _ in idle:
+                    self.discard(key, sock)
+                idle.clear()
+            self.condition.notify_all()
+
+
+default_pool = ConnectionPool(max_connections_per_host, idle_connection_timeout, request_timeout)
+
+
+class CachedResponse:
+    """Stored response with the request header values it varies on, the body is None while it is on disk"""
+
+    __slots__ = ("key", "version", "status", "reason", "headers", "varied", "body", "size")
+
+    def __init__(self, key: (str, int, str), version: str, status: int, reason: str, headers: dict[str, str],
+                 varied: dict[str, str | None], body: bytes | None, size: int):
+        self.key = key
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.varied = varied
+        self.body = body
+        self.size = size
+
+    def metadata(self) -> dict[str, any]:
+        """Everything but the body, as stored in front of it on disk"""
+        return {"key": list(self.key), "version": self.version, "status": self.status, "reason": self.reason,
+                "headers": self.headers, "varied": self.varied}
+
+    def validators(self) -> dict[str, str]:
+        """Conditional request headers asking the server whether the stored response is still current"""
+        validators = {}
+        etag = find_header(self.headers, "ETag")
+        if etag:
+            validators["If-None-Match"] = etag
+        modified = find_header(self.headers, "Last-Modified") or find_header(self.headers, "Date")
+        if modified:
+            validators["If-Modified-Since"] = modified
+        return validators
+
+    def response(self) -> Response:
+        """Response handed out in place of a 304 Not Modified"""
+        response = Response(self.version, self.status, self.reason, dict(self.headers), self.body)
+        response.from_cache = True
+        return response
+
+
+class ResponseCache:
+    """Responses to GET requests keyed by host, port and path. Every use is revalidated with a conditional request,
+    so an unchanged resource costs a 304 Not Modified instead of its body. Bodies are kept in memory or, given a
+    directory, in files there that outlive the process, and least recently used responses are evicted once their
+    total size exceeds the byte budget"""
+
+    def __init__(self, max_bytes: int = response_cache_size, directory: str | None = None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+
+    def load(self) -> None:
+        """Index the responses stored in the directory by an earlier process, least recently used first"""
+        stored = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                continue
+            try:
+                with open(path, 'rb') as cache_file:
+                    metadata = json.loads(cache_file.readline())
+                    stat = os.fstat(cache_file.fileno())
+                entry = CachedResponse(tuple(metadata["key"]), metadata["version"], metadata["status"],
+                                       metadata["reason"], metadata["headers"], metadata["varied"], None,
+                                       stat.st_size)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.debug(f"Ignoring unreadable cache file {path}: {e}")
+                continue
+            stored.append((stat.st_mtime, entry))
+        with self.lock:
+            for _, entry in sorted(stored, key=lambda item: item[0]):
+                self.entries[entry.key] = entry
+                self.size += entry.size
+            self.evict()
+
+    def lookup(self, key: (str, int, str), headers: dict[str, str] | None) -> CachedResponse | None:
+        """Stored response for a request or None, a body on disk is only read once the server confirmed it"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.varied != varied_values(entry.varied, headers):
+                return None
+            self.entries.move_to_end(key)
+        return entry
+
+    def read_body(self, entry: CachedResponse) -> bytes | None:
+        """Body of a response stored on disk, None if its file is gone or holds another version by now"""
+        path = self.file_path(entry.key)
+        try:
+            with open(path, 'rb') as cache_file:
+                metadata = json.loads(cache_file.readline())
+                body = cache_file.read()
+            os.utime(path)
+        except (OSError, ValueError) as e:
+            logging.debug(f"Cached response for {entry.key} is gone: {e}")
+            self.remove(entry.key)
+            return None
+        if not same_version(metadata.get("headers", {}), entry.headers):
+            logging.debug(f"Cached response for {entry.key} was replaced while it was revalidated")
+            self.remove(entry.key)
+            return None
+        return body
+
+    def update(self, method: str, key: (str, int, str), headers: dict[str, str] | None, response: Response,
+               cached: CachedResponse | None) -> Response | None:
+        """Record what a response says about the stored one and return the response to hand out, which is the
+        stored one when the server confirmed it is still current, or None if its body is no longer stored"""
+        if method not in ("GET", "HEAD"):
+            if response.status < 400:
+                self.remove(key)
+            return response
+        if response.status == 304:
+            if cached is None:
+                return response
+            body = cached.body if cached.body is not None else self.read_body(cached)
+            if body is None:
+                return None
+            refreshed = CachedResponse(key, cached.version, cached.status, cached.reason,
+                                       merge_headers(cached.headers, response.headers), cached.varied, body,
+                                       cached.size)
+            self.add(refreshed)
+            return refreshed.response()
+        if method == "GET" and response.status < 500:
+            if is_storable(headers, response):
+                varied = varied_values(dict.fromkeys(vary_names(response)), headers)
+                stored = {name: value for name, value in response.headers.items()
+                          if name.lower() not in hop_by_hop_headers}
+                self.add(CachedResponse(key, response.version, response.status, response.reason, stored, varied,
+                                        response.body, 0))
+            else:
+                self.remove(key)
+        return response
+
+    def add(self, entry: CachedResponse) -> None:
+        """Store a response, replacing the one stored for its key"""
+        metadata = json.dumps(entry.metadata()).encode() + b"\n"
+        entry.size = len(metadata) + len(entry.body)
+        if entry.size > self.max_bytes:
+            self.remove(entry.key)
+            return
+        if self.directory is not None:
+            path = self.file_path(entry.key)
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(temporary, 'wb') as cache_file:
+                    cache_file.write(metadata)
+                    cache_file.write(entry.body)
+                os.replace(temporary, path)
+            except OSError as e:
+                logging.warning(f"Storing the response for {entry.key} failed: {e}")
+                self.remove(entry.key)
+                return
+            entry = CachedResponse(entry.key, entry.version, entry.status, entry.reason, entry.headers,
+                                   entry.varied, None, entry.size)
+        with self.lock:
+            previous = self.entries.pop(entry.key, None)
+            if previous is not None:
+                self.size -= previous.size
+            self.entries[entry.key] = entry
+            self.size += entry.size
+            self.evict()
+
+    def remove(self, key: (str, int, str)) -> None:
+        """Drop the stored response for a key"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+                self.delete_file(key)
+
+    def evict(self) -> None:
+        """Drop least recently used responses until the budget is met, the lock must be held"""
+        while self.size > self.max_bytes:
+            key, entry = self.entries.popitem(last=False)
+            logging.debug(f"Evicting cached response for {key}")
+            self.size -= entry.size
+            self.delete_file(key)
+
+    def delete_file(self, key: (str, int, str)) -> None:
+        """Remove the file of a stored response if bodies are kept on disk"""
+        if self.directory is not None:
+            try:
+                os.remove(self.file_path(key))
+            except FileNotFoundError:
+                pass
+
+    def file_path(self, key: (str, int, str)) -> str:
+        """File holding the response stored for a key"""
+        return os.path.join(self.directory, hashlib.sha256(json.dumps(key).encode()).hexdigest())
+
+    def clear(self) -> None:
+        """Drop all stored responses"""
+        with self.lock:
+            for key in list(self.entries):
+                self.delete_file(key)
+            self.entries.clear()
+            self.size = 0
+
+
+def find_header(headers: dict[str, str], name: str, default: str | None = None) -> str | None:
+    """Case insensitive lookup of a header"""
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return default
+
+
+def cache_key(host: str, port: int, path: str) -> (str, int, str):
+    """Key of the responses for a resource, host names are case insensitive"""
+    return host.lower(), port, path
+
+
+def is_conditional(headers: dict[str, str] | None) -> bool:
+    """Check whether the caller validates or ranges the request itself, so the cache must stay out of it"""
+    names = {name.lower() for name in headers or {}}
+    return bool(names & {"if-none-match", "if-modified-since", "if-match", "if-unmodified-since", "if-range",
+                         "range"})
+
+
+def vary_names(response: Response) -> list[str]:
+    """Lowercase names of the request headers a response varies on"""
+    return [name.strip().lower() for name in response.header("Vary", "").split(",") if name.strip()]
+
+
+def varied_values(names: dict[str, any], headers: dict[str, str] | None) -> dict[str, str | None]:
+    """Values a request has for the headers named, None for the ones it does not send"""
+    return {name: find_header(headers or {}, name) for name in names}
+
+
+def is_storable(headers: dict[str, str] | None, response: Response) -> bool:
+    """Check whether a complete 200 response to a GET may be stored and can be revalidated later"""
+    request_cache_control = find_header(headers or {}, "Cache-Control", "")
+    return (response.status == 200 and response.chunks is None
+            and "no-store" not in response.header("Cache-Control", "").lower()
+            and "no-store" not in request_cache_control.lower()
+            and "*" not in vary_names(response)
+            and any(response.header(name) for name in ("ETag", "Last-Modified", "Date")))
+
+
+def same_version(stored: dict[str, str], expected: dict[str, str]) -> bool:
+    """Check whether two sets of stored headers describe the same version of a resource"""
+    return all(find_header(stored, name) == find_header(expected, name) for name in ("ETag", "Last-Modified"))
+
+
+def merge_headers(stored: dict[str, str], updates: dict[str, str]) -> dict[str, str]:
+    """Stored response headers updated with those of a 304 Not Modified, which say nothing about the body length"""
+    merged = dict(stored)
+    names = {name.lower(): name for name in merged}
+    for name, value in updates.items():
+        if name.lower() not in hop_by_hop_headers and name.lower() != "content-length":
+            merged.pop(names.get(name.lower()), None)
+            merged[name] = value
+    return merged
+
+
+def request(method: str, url: str, headers: dict[str, str] | None = None, body: bytes | str | None = None,
+            pool: ConnectionPool | None = None, stream: bool = False,
+            cache: ResponseCache | None = None) -> Response:
+    """Send a request over a pooled persistent connection and return the response, with the full body unless
+    streamed. Idempotent requests are retried once if a reused connection turns out to be closed. With a cache,
+    a stored response to a GET is revalidated and returned when the server answers 304"""
+    pool = pool or default_pool
+    host, port, path = split_url(url)
+    if isinstance(body, str):
+        body = to_bytes(body)
+    key = cache_key(host, port, path)
+    cached = None
+    if cache is not None and method == "GET" and not is_conditional(headers):
+        cached = cache.lookup(key, headers)
+    message = create_request(method, host_header(host, port), path, body,
+                             {**(headers or {}), **cached.validators()} if cached is not None else headers)
+    logging.debug(message)
+    retry = method in idempotent_methods
+    while True:
+        sock, reused = pool.acquire(host, port)
+        try:
+            send_request(sock, message)
+            response = read_response_head(ResponseReader(sock), method)
+        except ConnectionError:
+            pool.release(host, port, sock, False)
+            if reused and retry:
+                logging.debug("Reused connection failed, retrying once on a new connection")
+                retry = False
+                continue
+            raise
+        except BaseException:
+            pool.release(host, port, sock, False)
+            raise
+        if response is None:
+            pool.release(host, port, sock, False)
+            if reused and retry:
+                logging.debug("Reused connection was closed by the server, retrying once on a new connection")
+                retry = False
+                continue
+            raise IncompleteResponse("Connection closed before a response was received")
+        if stream and not (cached is not None and response.status == 304):
+            response.on_close = partial(pool.release, host, port, sock)
+            return cache.update(method, key, headers, response, cached) if cache is not None else response
+        try:
+            read_body(response)
+        except BaseException:
+            pool.release(host, port, sock, False)
+            raise
+        pool.release(host, port, sock, response.reusable)
+        if cache is None:
+            return response
+        updated = cache.update(method, key, headers, response, cached)
+        if updated is None:
+            logging.debug("Revalidated response is no longer stored, requesting it again")
+            return request(method, url, headers, body, pool, stream, cache)
+        return updated
+
+
+def download(url: str, path: str, parallelism: int = download_parallelism, pool: ConnectionPool | None = None) -> int:
+    """Download a resource into a file with ranged requests in parallel and return its size, an interrupted
+    download is resumed from the segments recorded in a state file next to it"""
+    pool = pool or default_pool
+    head = request("HEAD", url, pool=pool)
+    if head.status != 200:
+        raise IncompleteResponse(f"Download of {url} failed with status {head.status}")
+    size = head.header("Content-Length")
+    validator = head.header("ETag") or head.header("Last-Modified")
+    if size is None or validator is None or head.header("Accept-Ranges", "").lower() != "bytes":
+        logging.debug("Server does not support ranges for this resource, downloading it in one piece")
+        with request("GET", url, pool=pool, stream=True) as response, open(path, 'wb') as file:
+            return response.write_to(file)
+    size = int(size)
+    segments = [(offset, min(offset + download_segment_size, size) - 1)
+                for offset in range(0, size, download_segment_size)]
+    state_path = path + ".download"
+    state = load_download_state(state_path, url, size, validator)
+    pending = [segment for segment in segments if segment[0] not in state["done"]]
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        save_download_state(state_path, state)
+        lock = threading.Lock()
+        errors = []
+
+        def fetch_segments() -> None:
+            while not errors:
+                with lock:
+                    if not pending:
+                        return
+                    first, last = pending.pop(0)
+                try:
+                    fetch_segment(url, fd, first, last, validator, pool)
+                except Exception as e:
+                    errors.append(e)
+                    return
+                with lock:
+                    state["done"].append(first)
+                    save_download_state(state_path, state)
+
+        threads = [threading.Thread(target=fetch_segments) for _ in range(min(parallelism, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.remove(state_path)
+    return size
+
+
+def fetch_segment(url: str, fd: int, first: int, last: int, validator: str, pool: ConnectionPool) -> None:
+    """Receive one byte range of a download and write it at its offset"""
+    headers = {"Range": f"bytes={first}-{last}", "If-Range": validator}
+    with request("GET", url, headers, pool=pool, stream=True) as response:
+        if response.status != 206 or not response.header("Content-Range", "").startswith(f"bytes {first}-{last}/"):
+            raise IncompleteResponse(f"Range {first}-{last} of {url} was answered with status {response.status}, "
+                                     f"the resource changed or does not support ranges")
+        offset = first
+        for chunk in response.iter_content():
+            while chunk:
+                written = os.pwrite(fd, chunk, offset)
+                offset += written
+                chunk = chunk[written:]
+    if offset != last + 1:
+        raise IncompleteResponse(f"Range {first}-{last} of {url} ended at {offset}")
+
+
+def load_download_state(state_path: str, url: str, size: int, validator: str) -> dict[str, any]:
+    """Progress of an earlier attempt at the same download, or a fresh state if the resource changed"""
+    fresh = {"url": url, "size": size, "validator": validator, "done": []}
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return fresh
+    if (state.get("url"), state.get("size"), state.get("validator")) != (url, size, validator):
+        logging.debug("Resource changed since the interrupted download, starting over")
+        return fresh
+    logging.debug(f"Resuming download with {len(state['done'])} segments already done")
+    return state
+
+
+def save_download_state(state_path: str, state: dict[str, any]) -> None:
+    """Atomically record the progress of a download"""
+    with open(state_path + ".tmp", 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + ".tmp", state_path)
+
+
 def request_input(sock: socket.socket, uri: str):
     http_method = str(input("Enter HTTP method (HEAD, GET, PUT, POST):"))
     path = str(input("Enter path:"))
     if http_method == 'PUT' or http_method == 'POST':
-        body = str(input("Enter body:"))
+        body = to_bytes(str(input("Enter body:")))
     else:
         body = None
 
@@ -61,6 +717,18 @@ def split_uri(uri: str) -> (str, str):
     return uri, path
 
 
+def split_url(url: str) -> (str, int, str):
+    """Split a URL into host, port and path"""
+    authority, path = split_uri(url)
+    host, _, port = authority.partition(":")
+    return host, int(port) if port else 80, path
+
+
+def host_header(host: str, port: int) -> str:
+    """Value of the Host header for a host and port"""
+    return host if port == 80 else f"{host}:{port}"
+
+
 def make_connection(ip: str, port: int) -> socket:
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -74,6 +742,43 @@ def make_connection(ip: str, port: int) -> socket:
     return s
 
 
+def open_connection(host: str, port: int, timeout: float) -> socket.socket:
+    """Connect to a host for pooled use, small requests are sent without Nagle delays and with TCP Fast Open the
+    first request travels in the SYN when the server supports it"""
+    error = None
+    for family, kind, protocol, _, address in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        sock = socket.socket(family, kind, protocol)
+        try:
+            tune_socket(sock, True, socket_send_buffer, socket_receive_buffer)
+            if tcp_fast_open:
+                enable_fast_open_connect(sock)
+            sock.settimeout(timeout)
+            sock.connect(address)
+        except OSError as e:
+            sock.close()
+            error = e
+            continue
+        logging.debug("The socket has successfully connected to %s:%s.", host, port)
+        return sock
+    raise error or OSError(f"No address found for {host}")
+
+
+def is_connection_alive(sock: socket.socket) -> bool:
+    """Check that an idle connection was neither closed nor sent unexpected data by the server"""
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        data = sock.recv(1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+    logging.debug(f"Idle connection is unusable, received {data!r}")
+    return False
+
+
 def create_request_line(command: str, path: str) -> str:
     return f"{command} {path} HTTP/1.1"
 
@@ -105,7 +810,8 @@ def create_put_post_headers(uri: str, body: bytes) -> dict[str, str]:
     return headers
 
 
-def create_request(http_command: str, uri: str, path: str, body: bytes | None) -> bytes:
+def create_request(http_command: str, uri: str, path: str, body: bytes | None,
+                   extra_headers: dict[str, str] | None = None) -> bytes:
     request_line = create_request_line(http_command, path)
     if http_command == "HEAD":
         headers = create_head_headers(uri)
@@ -115,8 +821,12 @@ def create_request(http_command: str, uri: str, path: str, body: bytes | None) -
         headers = create_put_post_headers(uri, body)
     elif http_command == "POST":
         headers = create_put_post_headers(uri, body)
+    elif body is not None:
+        headers = create_put_post_headers(uri, body)
     else:
-        raise Exception("Error - unsupported method")
+        headers = create_generic_headers(uri)
+    if extra_headers:
+        headers.update(extra_headers)
 
     request = request_line + nlc
     for key in headers:
@@ -132,115 +842,143 @@ def send_request(sock: socket.socket, request: bytes):
     sock.sendall(request)
 
 
-def extract_response_line(response: bytes) -> (str, str, str, bytes):
-    """Extract and split response line from request"""
-    first_line_end = response.find(bnlc)
-    first_line = response[:first_line_end]
-    first = first_line.split(b" ")
-    version = first[0].decode()
-    status_code = first[1].decode()
-    reason_phrase = first[2].decode()
-    return version, status_code, reason_phrase, response[first_line_end + 2:]
-
-
-def read_header_response(sock: socket, response: bytes):
-    while not response.endswith(bnlc + bnlc):
-        """until two newlines are received (signifying the end of the HTTP response) 
-        we keep pulling data from the socket"""
-        logging.debug("Response didn't end with 2 newline characters, receiving more data.")
-        data = sock.recv(max_buffer_size)
-        response += data
-    print(response)
-
-
-def read_content_length_response(sock: socket, response: bytes, remainder: bytes, headers: dict[bytes, bytes]):
-    logging.debug("Fetching data until all is received according to Content-Length header")
-    content_length = headers[b"Content-Length"]
-    while len(remainder) != int(content_length):
-        data = sock.recv(max_buffer_size)
-        response += data
-        remainder += data
-    encoding = extract_encoding(headers)
-    print(response.decode(encoding))
-
-
-def read_chunked_response(sock: socket, response: bytes, remainder: bytes, headers: dict[bytes, bytes]):
-    logging.debug("Fetching data until all is received according to chunking")
+def extract_response_line(line: bytes) -> (str, int, str):
+    """Split a response line into version, status code and reason phrase"""
+    parts = line.split(b" ", 2)
+    version = parts[0].decode()
+    status_code = int(parts[1])
+    reason_phrase = parts[2].decode() if len(parts) > 2 else ""
+    return version, status_code, reason_phrase
+
+
+def extract_headers(header_block: bytes) -> dict[str, str]:
+    """Split header lines and return them as dictionary"""
+    headers = {}
+    for line in header_block.split(bnlc):
+        name, _, value = line.partition(b":")
+        headers[name.strip().decode()] = value.strip().decode()
+    return headers
+
+
+def receive_response(sock: socket, method: str) -> Response | None:
+    """Receive a full response and print it"""
+    response = read_response(sock, method)
+    if response is None:
+        logging.debug("No data received from socket, indicating connection was closed from server side")
+        return None
+    print(f"{response.version} {response.status} {response.reason}")
+    for name, value in response.headers.items():
+        print(f"{name}: {value}")
+    print()
+    if response.body:
+        print(response.text())
+    return response
+
+
+def read_response(sock: socket, method: str) -> Response | None:
+    """Read one full response, None if the connection was closed before any of it arrived"""
+    response = read_response_head(ResponseReader(sock), method)
+    if response is not None:
+        read_body(response)
+    return response
+
+
+def read_response_head(reader: ResponseReader, method: str) -> Response | None:
+    """Read the status line and headers of a response, its body is left to the chunks iterator"""
+    try:
+        head_end = reader.find(bnlc + bnlc)
+    except IncompleteResponse:
+        if reader.available():
+            raise
+        return None
+    line_end = reader.buffer.find(bnlc, reader.start, head_end)
+    version, status, reason = extract_response_line(bytes(reader.view[reader.start:line_end]))
+    headers = extract_headers(bytes(reader.view[line_end + 2:head_end])) if line_end < head_end else {}
+    response = Response(version, status, reason, headers, b"")
+    response.head_size = head_end + 4 - reader.start
+    reader.start = head_end + 4
+    framing = body_framing(response, method)
+    response.reader = reader
+    response.persistent = (framing != "close" and version == "HTTP/1.1"
+                           and response.header("Connection", "").lower() != "close")
+    response.chunks = iter_body(reader, framing, int(response.header("Content-Length", "0") or 0))
+    return response
+
+
+def read_body(response: Response) -> None:
+    """Receive the rest of a response body into memory"""
+    body = bytearray()
+    for chunk in response.chunks:
+        body += chunk
+    response.body = bytes(body)
+    response.chunks = None
+    response.completed()
+
+
+def body_framing(response: Response, method: str) -> str:
+    """How the end of the response body is found: none, chunked, length or close"""
+    if method == "HEAD" or response.status in (204, 304) or 100 <= response.status < 200:
+        return "none"
+    if response.header("Transfer-Encoding", "").lower() == "chunked":
+        return "chunked"
+    if response.header("Content-Length") is not None:
+        return "length"
+    return "close"
+
+
+def iter_body(reader: ResponseReader, framing: str, size: int) -> Iterator[memoryview]:
+    """Body chunks framed as the response headers describe"""
+    if framing == "chunked":
+        logging.debug("Fetching data until all is received according to chunking")
+        yield from iter_chunked_body(reader)
+    elif framing == "length":
+        logging.debug("Fetching data until all is received according to Content-Length header")
+        yield from iter_sized_body(reader, size)
+    elif framing == "close":
+        logging.debug("Fetching data until the connection is closed")
+        yield from iter_body_until_closed(reader)
+
+
+def iter_sized_body(reader: ResponseReader, size: int) -> Iterator[memoryview]:
+    """Exactly size bytes of body"""
+    reader.reserve(size)
+    while size:
+        chunk = reader.take(size)
+        size -= len(chunk)
+        yield chunk
+
+
+def iter_chunked_body(reader: ResponseReader) -> Iterator[memoryview]:
+    """Decode a chunked body as it arrives, trailers are read and dropped"""
+    reader.reserve(receive_buffer_size)
     while True:
-        split = remainder.split(bnlc, 1)
-        line = split[0]
-        chunk_length = int(line, base=16)
+        chunk_length = int(reader.read_line().split(b";", 1)[0], base=16)
         if chunk_length == 0:
             break
-        remainder = split[1]
-        rem_length = len(remainder)
-        if rem_length > chunk_length:
-            remainder = remainder[chunk_length + 2:]
-        elif rem_length <= chunk_length:
-            while rem_length < chunk_length:
-                data = sock.recv(max_buffer_size)
-                response += data
-                remainder += data
-                rem_length = len(remainder)
-            remainder = remainder[chunk_length + 2:]
-    encoding = extract_encoding(headers)
-    print(response.decode(encoding))
-
-
-def receive_response(sock: socket, method: str):
-    response = sock.recv(max_buffer_size)
-    if not response:
-        logging.debug("No data received from socket, indicating connection was closed from server side")
-        return
-    elif response:
-        version, status_code, reason_phrase, remainder = extract_response_line(response)
-        if method == "HEAD":
-            read_header_response(sock, response)
-        else:
-            headers, remainder = extract_headers(remainder)
-            if b"Content-Length" in headers:
-                read_content_length_response(sock, response, remainder, headers)
-            elif b"Transfer-Encoding" in headers and headers[b"Transfer-Encoding"] == b"chunked":
-                read_chunked_response(sock, response, remainder, headers)
-            else:
-                raise Exception
+        yield from iter_sized_body(reader, chunk_length)
+        if reader.read_line():
+            raise ValueError("Chunk data not followed by a line ending")
+    while reader.read_line():
+        pass
 
 
-def extract_encoding(headers: dict[bytes, bytes]) -> str:
-    if b"Content-Type" in headers and b"charset=" in headers[b"Content-Type"]:
-        charset_match = re.findall(rb"charset=(\S+)", headers[b"Content-Type"])
+def iter_body_until_closed(reader: ResponseReader) -> Iterator[memoryview]:
+    """Body delimited by the server closing the connection"""
+    reader.reserve(receive_buffer_size)
+    while True:
+        try:
+            yield reader.take(receive_buffer_size)
+        except IncompleteResponse:
+            return
+
+
+def extract_encoding(content_type: str) -> str:
+    if "charset=" in content_type:
+        charset_match = re.findall(r"charset=([^\s;]+)", content_type)
         if len(charset_match) > 0:
-            return charset_match[0].decode('utf-8')
+            return charset_match[0]
     return 'utf-8'
 
 
-def extract_headers(response: bytes) -> (dict[bytes, bytes], bytes):
-    """Split headers and return as dictionary"""
-    split = response.split(bnlc + bnlc, 1)
-    header_block = split[0]
-    body = split[1]
-    headers = {}
-    header_match = re.findall(rb"(\S+): ([\S ]+)", header_block)
-    for name, value in header_match:
-        headers[name] = value
-    return headers, body
-
-
-start_client()
-
-# def test():
-#     uri = 'localhost'
-#     port = 8080
-#     method = 'GET'
-#     path = '/'
-#     body = None
-#     ip = socket.gethostbyname(uri)
-#
-#     s = make_connection(ip, port)
-#     request = create_request(method, uri, path, body)
-#     logging.debug(request)
-#     send_request(s, request)
-#     receive_response(s, method)
-#
-#
-# test()
+if __name__ == "__main__":
+    start_client()
@@ -0,0 +1,246 @@
+import hashlib
+import logging
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Callable
+
+entry_overhead = 1024
+
+
+class CachedFile:
+    """Content and metadata of a cached file, body is None for files too large to keep in memory"""
+
+    def __init__(self, path: str, file_stat: os.stat_result, body: bytes | None, media_type: str,
+                 digest: str | None = None):
+        self.path = path
+        self.size = len(body) if body is not None else file_stat.st_size
+        self.mtime = file_stat.st_mtime
+        self.mtime_ns = file_stat.st_mtime_ns
+        self.inode = file_stat.st_ino
+        self.body = body
+        self.media_type = media_type
+        self.last_modified = formatdate(file_stat.st_mtime, usegmt=True)
+        self.etag = f'"{digest}"' if digest else f'"{self.inode:x}-{self.size:x}-{self.mtime_ns:x}"'
+        self.headers = {"Content-Type": media_type, "Content-Length": self.size, "Last-Modified": self.last_modified,
+                        "ETag": self.etag, "Accept-Ranges": "bytes"}
+        self.validated = time.monotonic()
+
+    def matches(self, file_stat: os.stat_result) -> bool:
+        """Check whether a fresh stat result still describes the cached file"""
+        return (self.inode, self.size, self.mtime_ns) == (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+
+class FileCache:
+    """LRU cache of files bounded by a byte budget, revalidated against stat at most once per interval.
+    Entity tags are derived from stat, or from a content hash computed once per file version if hash_content is set"""
+
+    def __init__(self, max_bytes: int, max_file_size: int, revalidate_interval: float,
+                 media_type_of: Callable[[str], str], hash_content: bool = False):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate_interval = revalidate_interval
+        self.media_type_of = media_type_of
+        self.hash_content = hash_content
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, path: str) -> CachedFile | None:
+        """Return the cached file for a path, None if it is not a regular file"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+                if now - entry.validated < self.revalidate_interval:
+                    return entry
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):
+            self.invalidate(path)
+            return None
+        if entry is not None and entry.matches(file_stat):
+            entry.validated = now
+            return entry
+        entry = self.load(path, file_stat)
+        if entry is not None:
+            self.store(entry)
+        return entry
+
+    def load(self, path: str, file_stat: os.stat_result) -> CachedFile | None:
+        """Read a file into a new cache entry, only metadata is kept for large files"""
+        if file_stat.st_size > self.max_file_size and not self.hash_content:
+            return CachedFile(path, file_stat, None, self.media_type_of(path))
+        try:
+            with open(path, 'rb') as fd:
+                file_stat = os.fstat(fd.fileno())
+                if file_stat.st_size > self.max_file_size:
+                    body = None
+                    digest = hashlib.file_digest(fd, content_hash).hexdigest()
+                else:
+                    body = fd.read()
+                    digest = content_hash(body).hexdigest() if self.hash_content else None
+        except OSError:
+            return None
+        logging.debug("Loaded %s into the file cache", path)
+        return CachedFile(path, file_stat, body, self.media_type_of(path), digest)
+
+    def store(self, entry: CachedFile) -> None:
+        """Add an entry and evict the least recently used ones until the byte budget is respected"""
+        with self.lock:
+            self.remove(entry.path)
+            self.entries[entry.path] = entry
+            self.used_bytes += entry_cost(entry)
+            while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.used_bytes -= entry_cost(evicted)
+                logging.debug("Evicted %s from the file cache", evicted.path)
+
+    def invalidate(self, path: str) -> None:
+        """Drop a path from the cache, e.g. after it was written"""
+        with self.lock:
+            self.remove(path)
+
+    def remove(self, path: str) -> None:
+        """Remove an entry, the lock must be held"""
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.used_bytes -= entry_cost(entry)
+
+
+def content_hash(data: bytes = b"") -> "hashlib.blake2b":
+    """Hash used for content based entity tags"""
+    return hashlib.blake2b(data, digest_size=16)
+
+
+def entry_cost(entry: CachedFile) -> int:
+    """Bytes an entry counts against the cache budget, its body plus a nominal overhead for the metadata, so that
+    entries of files too large to keep in memory are evicted as well"""
+    return entry_overhead + (len(entry.body) if entry.body is not None else 0)
+
+
+class VariantCache:
+    """LRU cache of encoded variants of files bounded by a byte budget, keyed by path and file version"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> bytes | None:
+        """Return a cached variant, None if it is not cached"""
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def store(self, key: tuple, body: bytes) -> None:
+        """Add a variant and evict the least recently used ones until the byte budget is respected"""
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.used_bytes -= len(previous)
+            self.entries[key] = body
+            self.used_bytes += len(body)
+            while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.used_bytes -= len(evicted)
+
+
+class DirectoryIndex:
+    """Files and directories below a document root, rescanned in the background at most once per interval so that
+    lookups of unknown paths are answered from memory. Files written by the server are added right away, files
+    created by others become visible after the next rescan. Symbolic links to directories are not descended into
+    and files whose name starts with a hidden prefix, like spooled uploads, are never indexed"""
+
+    def __init__(self, root: str, rescan_interval: float, index_files: tuple[str, ...] = ("index.html",),
+                 hidden_prefix: str | None = None):
+        self.root = root
+        self.rescan_interval = rescan_interval
+        self.index_files = index_files
+        self.hidden_prefix = hidden_prefix
+        self.files = set()
+        self.directories = set()
+        self.added = set()
+        self.scanned = None
+        self.scanning = threading.Lock()
+        self.adding = threading.Lock()
+
+    def lookup(self, path: str) -> str | None:
+        """Path of the file serving a path, the index file for a directory, None if there is none"""
+        self.refresh()
+        path = path.rstrip("/") or path
+        if path in self.files:
+            return path
+        if path in self.directories:
+            for name in self.index_files:
+                index_path = f"{path}/{name}"
+                if index_path in self.files:
+                    return index_path
+        return None
+
+    def contains(self, path: str) -> bool:
+        """Check whether a regular file is known at a path"""
+        self.refresh()
+        return path in self.files
+
+    def add(self, path: str) -> None:
+        """Record a file written by the server, also when a rescan is running"""
+        with self.adding:
+            self.files.add(path)
+            self.added.add(path)
+
+    def refresh(self) -> None:
+        """Scan on first use, afterwards start a background rescan once the index is older than the interval"""
+        if self.scanned is None:
+            with self.scanning:
+                if self.scanned is None:
+                    self.rescan()
+        elif time.monotonic() - self.scanned >= self.rescan_interval and self.scanning.acquire(blocking=False):
+            threading.Thread(target=self.rescan_in_background, name="directory-index", daemon=True).start()
+
+    def rescan_in_background(self) -> None:
+        """Rescan holding the scanning lock acquired by refresh"""
+        try:
+            self.rescan()
+        finally:
+            self.scanning.release()
+
+    def rescan(self) -> None:
+        """Walk the whole tree and swap in the new sets, keeping files added while walking"""
+        started = time.monotonic()
+        with self.adding:
+            self.added = set()
+        files, directories = set(), {self.root}
+        pending = [self.root]
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir():
+                                directories.add(entry.path)
+                                if not entry.is_symlink():
+                                    pending.append(entry.path)
+                            elif entry.is_file() and not (self.hidden_prefix
+                                                          and entry.name.startswith(self.hidden_prefix)):
+                                files.add(entry.path)
+                        except OSError:
+                            continue
+            except OSError as e:
+                logging.debug("Scanning %s failed: %s", directory, e)
+        with self.adding:
+            files |= self.added
+            self.files, self.directories = files, directories
+        self.scanned = started
+        logging.debug("Indexed %d files below %s in %.3fs", len(files), self.root, time.monotonic() - started)
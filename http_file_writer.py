@@ -0,0 +1,240 @@
+import logging
+import os
+import queue
+import stat
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO
+
+fsync_policies = ("none", "interval", "always")
+lock_stripes = 64
+append_batch_size = 256
+inline_append_size = 64 * 1024
+copy_chunk_size = 64 * 1024
+
+
+class PendingAppend:
+    """Body waiting to be appended to a file by the writer thread"""
+
+    __slots__ = ("path", "body", "done", "error")
+
+    def __init__(self, path: str, body: bytes | BinaryIO):
+        self.path = path
+        self.body = body
+        self.done = threading.Event()
+        self.error = None
+
+
+class FileWriter:
+    """Serializes writes to files below the document root. Writes to the same path are ordered by striped per-path
+    locks, PUT bodies replace their target atomically and POST bodies are appended by a writer thread that commits
+    everything queued while it was busy in one batch, with the handles of recently appended files kept open.
+    The fsync policy trades durability for throughput: none leaves flushing to the kernel, interval syncs appended
+    files at most once per interval and always syncs before a write is acknowledged"""
+
+    def __init__(self, fsync_policy: str = "none", fsync_interval: float = 1.0, max_open_files: int = 64):
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.max_open_files = max_open_files
+        self.locks = [threading.Lock() for _ in range(lock_stripes)]
+        self.pending = queue.SimpleQueue()
+        self.handles = OrderedDict()
+        self.handles_lock = threading.Lock()
+        self.dirty = set()
+        self.sync_due = None
+        self.thread = None
+        self.starting = threading.Lock()
+
+    def lock_for(self, path: str) -> threading.Lock:
+        """Lock ordering the writes to a path, shared with the paths hashing to the same stripe"""
+        return self.locks[hash(path) % lock_stripes]
+
+    def replace(self, body_file: BinaryIO, path: str) -> bool:
+        """Move a spooled body into place, keeping the mode of the file it replaces. Returns whether it was created"""
+        body_file.flush()
+        if self.fsync_policy == "always":
+            os.fsync(body_file.fileno())
+        body_file.close()
+        with self.lock_for(path):
+            try:
+                mode = os.stat(path).st_mode
+                created = not stat.S_ISREG(mode)
+            except FileNotFoundError:
+                created = True
+            os.chmod(body_file.name, 0o644 if created else stat.S_IMODE(mode))
+            os.replace(body_file.name, path)
+            self.forget(path)
+        if self.fsync_policy == "always":
+            sync_directory(os.path.dirname(path))
+        return created
+
+    def append(self, path: str, body_file: BinaryIO) -> None:
+        """Append a spooled body to a file, returns once it is written and raises the OSError of a failed write.
+        Small bodies are read into memory so that a batch of them is written with a single call"""
+        body_file.seek(0)
+        body = body_file.read(inline_append_size + 1)
+        if len(body) > inline_append_size:
+            body_file.seek(0)
+            body = body_file
+        append = PendingAppend(path, body)
+        self.start()
+        self.pending.put(append)
+        append.done.wait()
+        if append.error is not None:
+            raise append.error
+
+    def start(self) -> None:
+        """Start the writer thread on first use, so that it runs in the process that serves, e.g. after a fork"""
+        if self.thread is None:
+            with self.starting:
+                if self.thread is None:
+                    thread = threading.Thread(target=self.run, name="file-writer", daemon=True)
+                    thread.start()
+                    self.thread = thread
+
+    def run(self) -> None:
+        """Commit queued appends in batches until a None sentinel is received"""
+        stopping = False
+        while not stopping:
+            timeout = max(self.sync_due - time.monotonic(), 0) if self.sync_due is not None else None
+            try:
+                append = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                self.sync_dirty()
+                continue
+            batch = []
+            while append is not None:
+                batch.append(append)
+                if len(batch) == append_batch_size or self.pending.empty():
+                    break
+                append = self.pending.get_nowait()
+            stopping = append is None
+            self.commit(batch)
+            if self.sync_due is not None and time.monotonic() >= self.sync_due:
+                self.sync_dirty()
+        self.sync_dirty()
+        with self.handles_lock:
+            for fd in self.handles.values():
+                os.close(fd)
+            self.handles.clear()
+
+    def commit(self, batch: list[PendingAppend]) -> None:
+        """Append a batch path by path with one write for consecutive in-memory bodies, then acknowledge it"""
+        by_path = {}
+        for append in batch:
+            by_path.setdefault(append.path, []).append(append)
+        for path, appends in by_path.items():
+            written = 0
+            with self.lock_for(path):
+                try:
+                    fd = self.handle(path)
+                    while written < len(appends):
+                        if isinstance(appends[written].body, bytes):
+                            end = written
+                            while end < len(appends) and isinstance(appends[end].body, bytes):
+                                end += 1
+                            write_all(fd, b"".join(append.body for append in appends[written:end]))
+                        else:
+                            end = written + 1
+                            copy_all(fd, appends[written].body)
+                        written = end
+                    if self.fsync_policy == "always":
+                        os.fsync(fd)
+                    elif self.fsync_policy == "interval":
+                        self.dirty.add(path)
+                        if self.sync_due is None:
+                            self.sync_due = time.monotonic() + self.fsync_interval
+                except OSError as e:
+                    logging.error("Appending to %s failed: %s", path, e)
+                    for append in appends[written:]:
+                        append.error = e
+                    self.forget(path)
+            for append in appends:
+                append.done.set()
+
+    def handle(self, path: str) -> int:
+        """Open append handle of a path, reopened when the file was replaced or removed by another process.
+        The path lock must be held"""
+        with self.handles_lock:
+            fd = self.handles.get(path)
+            if fd is not None:
+                self.handles.move_to_end(path)
+        if fd is not None:
+            try:
+                current = os.stat(path)
+                opened = os.fstat(fd)
+                if (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino):
+                    return fd
+            except FileNotFoundError:
+                pass
+            self.forget(path)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        with self.handles_lock:
+            self.handles[path] = fd
+            evicted = self.handles.popitem(last=False) if len(self.handles) > self.max_open_files else None
+        if evicted is not None:
+            self.close_handle(*evicted)
+        return fd
+
+    def forget(self, path: str) -> None:
+        """Close the append handle of a path, e.g. after the file was replaced"""
+        with self.handles_lock:
+            fd = self.handles.pop(path, None)
+        if fd is not None:
+            self.close_handle(path, fd)
+
+    def close_handle(self, path: str, fd: int) -> None:
+        """Close an append handle, syncing it first if it has unsynced appends"""
+        try:
+            if path in self.dirty:
+                self.dirty.discard(path)
+                os.fsync(fd)
+        except OSError as e:
+            logging.error("Syncing %s failed: %s", path, e)
+        finally:
+            os.close(fd)
+
+    def sync_dirty(self) -> None:
+        """Sync the files appended to since the last sync"""
+        self.sync_due = None
+        for path in list(self.dirty):
+            with self.lock_for(path):
+                self.dirty.discard(path)
+                with self.handles_lock:
+                    fd = self.handles.get(path)
+                if fd is None:
+                    continue
+                try:
+                    os.fsync(fd)
+                except OSError as e:
+                    logging.error("Syncing %s failed: %s", path, e)
+
+    def close(self) -> None:
+        """Commit the queued appends, sync them and close the handles"""
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def write_all(fd: int, data: bytes) -> None:
+    """Write all of a buffer, regular files may accept less than asked for"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def copy_all(fd: int, body_file: BinaryIO) -> None:
+    """Append the rest of a spooled body"""
+    while chunk := body_file.read(copy_chunk_size):
+        write_all(fd, chunk)
+
+
+def sync_directory(path: str) -> None:
+    """Sync a directory so that a rename in it survives a crash"""
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
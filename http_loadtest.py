@@ -0,0 +1,280 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from email.utils import formatdate
+
+import http_client
+from http_client import IncompleteResponse, create_request, host_header, open_connection, read_response, \
+    send_request, split_url
+
+duration = 10.0
+connection_count = 16
+process_count = 2
+idle_connection_count = 1000
+connect_timeout = 10.0
+large_file_size = 8 * 1024 * 1024
+upload_size = 64 * 1024
+load_models = ("threads", "processes")
+
+# logging.basicConfig(level=logging.DEBUG)
+
+WorkItem = tuple[str, str, dict[str, str], bytes | None]
+
+
+class Stats:
+    """Latencies and counters collected by load generating connections"""
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def record(self, latency: float, status: int, sent: int, received: int) -> None:
+        """Count one completed request"""
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+
+    def merge(self, other: "Stats") -> None:
+        """Add the results of another set of connections"""
+        self.latencies.extend(other.latencies)
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.errors += other.errors
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+
+
+def small_file_scenario(url: str) -> list[WorkItem]:
+    """GET of a small file served from the in-memory cache"""
+    return [("GET", "/404_not_found.html", {}, None)]
+
+
+def large_file_scenario(url: str) -> list[WorkItem]:
+    """GET of a file too large for the cache, sent with sendfile"""
+    http_client.request("PUT", url + "/loadtest_large.bin", body=os.urandom(large_file_size))
+    return [("GET", "/loadtest_large.bin", {}, None)]
+
+
+def revalidation_scenario(url: str) -> list[WorkItem]:
+    """Conditional GET answered with 304 Not Modified"""
+    http_client.request("PUT", url + "/loadtest_small.txt", body=b"revalidated")
+    time.sleep(1.1)
+    head = http_client.request("HEAD", url + "/loadtest_small.txt")
+    if head.header("ETag"):
+        return [("GET", "/loadtest_small.txt", {"If-None-Match": head.header("ETag")}, None)]
+    since = head.header("Last-Modified") or formatdate(time.time(), usegmt=True)
+    return [("GET", "/loadtest_small.txt", {"If-Modified-Since": since}, None)]
+
+
+def upload_scenario(url: str) -> list[WorkItem]:
+    """PUT of a body spooled to disk and atomically replacing the target"""
+    return [("PUT", "/loadtest_upload.bin", {}, os.urandom(upload_size))]
+
+
+def large_upload_scenario(url: str) -> list[WorkItem]:
+    """PUT of a large body, dominated by how the server receives data"""
+    return [("PUT", "/loadtest_large_upload.bin", {}, os.urandom(large_file_size))]
+
+
+def mixed_scenario(url: str) -> list[WorkItem]:
+    """Interleaved HEAD, GET, PUT and POST requests"""
+    http_client.request("PUT", url + "/loadtest_append.txt", body=b"")
+    return [("GET", "/404_not_found.html", {}, None),
+            ("HEAD", "/404_not_found.html", {}, None),
+            ("GET", "/missing.html", {}, None),
+            ("PUT", "/loadtest_mixed.txt", {}, b"mixed"),
+            ("POST", "/loadtest_append.txt", {}, b"x")]
+
+
+scenarios = {
+    "small": small_file_scenario,
+    "large": large_file_scenario,
+    "revalidate": revalidation_scenario,
+    "upload": upload_scenario,
+    "large_upload": large_upload_scenario,
+    "idle": small_file_scenario,
+    "mixed": mixed_scenario,
+}
+
+
+def load_workload(path: str) -> list[WorkItem]:
+    """Read work items from a JSON lines file with method, path and optional headers and body"""
+    items = []
+    with open(path) as workload_file:
+        for line in workload_file:
+            if line.strip():
+                entry = json.loads(line)
+                body = entry.get("body")
+                items.append((entry["method"], entry["path"], entry.get("headers", {}),
+                              body.encode() if body is not None else None))
+    return items
+
+
+def run_connection(host: str, port: int, items: list[WorkItem], first: int, deadline: float,
+                   stats: Stats) -> None:
+    """Replay the work items in turn over one persistent connection until the deadline"""
+    messages = [(method, create_request(method, host_header(host, port), path, body, headers))
+                for method, path, headers, body in items]
+    index = first
+    sock = None
+    while time.monotonic() < deadline:
+        method, message = messages[index % len(messages)]
+        index += 1
+        try:
+            if sock is None:
+                sock = open_connection(host, port, connect_timeout)
+            start = time.perf_counter()
+            send_request(sock, message)
+            response = read_response(sock, method)
+            latency = time.perf_counter() - start
+            if response is None:
+                raise IncompleteResponse("Connection closed before a response was received")
+        except (OSError, IncompleteResponse, ValueError) as e:
+            logging.debug(f"Request failed: {e}")
+            stats.errors += 1
+            if sock is not None:
+                sock.close()
+                sock = None
+            continue
+        stats.record(latency, response.status, len(message), response.head_size + len(response.body))
+        if not response.reusable:
+            sock.close()
+            sock = None
+    if sock is not None:
+        sock.close()
+
+
+def run_threads(host: str, port: int, items: list[WorkItem], connections: int, seconds: float,
+                first: int = 0) -> Stats:
+    """Generate load from one thread per connection"""
+    deadline = time.monotonic() + seconds
+    results = [Stats() for _ in range(connections)]
+    threads = [threading.Thread(target=run_connection,
+                                args=(host, port, items, first + number, deadline, results[number]))
+               for number in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = Stats()
+    for result in results:
+        stats.merge(result)
+    return stats
+
+
+def run_processes(host: str, port: int, items: list[WorkItem], connections: int, seconds: float,
+                  processes: int) -> Stats:
+    """Generate load from several processes, each running its share of the connections in threads"""
+    shares = [connections // processes + (1 if number < connections % processes else 0)
+              for number in range(processes)]
+    arguments = [(host, port, items, share, seconds, sum(shares[:number]))
+                 for number, share in enumerate(shares) if share]
+    with multiprocessing.Pool(len(arguments)) as pool:
+        results = pool.starmap(run_threads, arguments)
+    stats = Stats()
+    for result in results:
+        stats.merge(result)
+    return stats
+
+
+def open_idle_connections(host: str, port: int, count: int) -> list[socket.socket]:
+    """Open connections that stay silent for the whole run"""
+    sockets = []
+    for _ in range(count):
+        try:
+            sockets.append(open_connection(host, port, connect_timeout))
+        except OSError as e:
+            logging.warning(f"Opened only {len(sockets)} idle connections: {e}")
+            break
+    return sockets
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarize(stats: Stats, elapsed: float) -> dict[str, any]:
+    """Throughput, latency percentiles in milliseconds and error counts of a run"""
+    ordered = sorted(stats.latencies)
+    return {
+        "requests": len(ordered),
+        "errors": stats.errors,
+        "statuses": {str(status): count for status, count in sorted(stats.statuses.items())},
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(ordered) / elapsed, 1),
+        "sent_bytes_per_second": round(stats.bytes_sent / elapsed),
+        "received_bytes_per_second": round(stats.bytes_received / elapsed),
+        "latency_ms": {name: round(percentile(ordered, fraction) * 1000, 3)
+                       for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+    }
+
+
+def print_summary(summary: dict[str, any]) -> None:
+    """Print a run summary for humans"""
+    latency = summary["latency_ms"]
+    print(f"requests: {summary['requests']} in {summary['seconds']}s, errors: {summary['errors']}, "
+          f"statuses: {summary['statuses']}")
+    print(f"throughput: {summary['requests_per_second']} req/s, "
+          f"{summary['received_bytes_per_second'] / 1048576:.2f} MiB/s received, "
+          f"{summary['sent_bytes_per_second'] / 1048576:.2f} MiB/s sent")
+    print(f"latency ms: p50 {latency['p50']}, p95 {latency['p95']}, p99 {latency['p99']}, max {latency['max']}")
+
+
+def main():
+    """Parse command line options, run a scenario or workload against a server and report the results"""
+    parser = argparse.ArgumentParser(description="HTTP workshop load generator")
+    parser.add_argument("url", help="server to load, e.g. http://127.0.0.1:8080")
+    parser.add_argument("--scenario", choices=scenarios, default="small", help="built-in benchmark scenario")
+    parser.add_argument("--workload", help="JSON lines file of requests to replay instead of a scenario")
+    parser.add_argument("--connections", type=int, default=connection_count, help="concurrent keep-alive connections")
+    parser.add_argument("--duration", type=float, default=duration, help="seconds to generate load")
+    parser.add_argument("--model", choices=load_models, default="threads",
+                        help="threads: one thread per connection, processes: connections split over processes")
+    parser.add_argument("--processes", type=int, default=process_count, help="processes in the processes model")
+    parser.add_argument("--idle-connections", type=int, default=None,
+                        help=f"silent connections held open during the run, {idle_connection_count} for idle")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    parser.add_argument("--tcp-fast-open", action="store_true", help="send requests of new connections in the SYN")
+    parser.add_argument("--send-buffer", type=int, help="SO_SNDBUF of the client connections in bytes")
+    parser.add_argument("--receive-buffer", type=int, help="SO_RCVBUF of the client connections in bytes")
+    args = parser.parse_args()
+    http_client.tcp_fast_open = args.tcp_fast_open
+    http_client.socket_send_buffer = args.send_buffer
+    http_client.socket_receive_buffer = args.receive_buffer
+    host, port, _ = split_url(args.url)
+    url = args.url.rstrip("/")
+    items = load_workload(args.workload) if args.workload else scenarios[args.scenario](url)
+    idle_count = args.idle_connections
+    if idle_count is None:
+        idle_count = idle_connection_count if args.scenario == "idle" and not args.workload else 0
+    idle = open_idle_connections(host, port, idle_count)
+    start = time.monotonic()
+    try:
+        if args.model == "processes":
+            stats = run_processes(host, port, items, args.connections, args.duration, args.processes)
+        else:
+            stats = run_threads(host, port, items, args.connections, args.duration)
+    finally:
+        for sock in idle:
+            sock.close()
+    summary = summarize(stats, time.monotonic() - start)
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
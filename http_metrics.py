@@ -0,0 +1,178 @@
+import logging
+import os
+import queue
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+known_methods = ("GET", "HEAD", "PUT", "POST")
+access_log_batch_size = 1024
+access_log_flush_interval = 1.0
+
+wall_clock_offset = time.time() - time.monotonic()
+
+
+class RequestTiming:
+    """Monotonic timestamps and outcome of one request, from accepting its connection to sending its last byte"""
+
+    __slots__ = ("peer", "method", "uri", "version", "status", "size", "accepted", "first_byte", "parsed", "handled",
+                 "finished")
+
+    def __init__(self, peer: str | None, method: str, uri: str, version: str, status: int, size: int,
+                 accepted: float, first_byte: float, parsed: float, handled: float, finished: float):
+        self.peer = peer
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.status = status
+        self.size = size
+        self.accepted = accepted
+        self.first_byte = first_byte
+        self.parsed = parsed
+        self.handled = handled
+        self.finished = finished
+
+    def to_json(self) -> str:
+        """Access log line with the wall clock time of the first byte and the duration of each phase"""
+        wall_clock = self.first_byte + wall_clock_offset
+        return ('{"time": "%s.%03dZ", "peer": %s, "method": %s, "uri": %s, "version": %s, "status": %d, "bytes": %d, '
+                '"connection_age": %.6f, "parse": %.6f, "handle": %.6f, "send": %.6f, "total": %.6f}' % (
+                    format_second(int(wall_clock)), wall_clock % 1 * 1000,
+                    json_string(self.peer), json_string(self.method), json_string(self.uri),
+                    json_string(self.version), self.status, self.size,
+                    self.first_byte - self.accepted, self.parsed - self.first_byte, self.handled - self.parsed,
+                    self.finished - self.handled, self.finished - self.first_byte))
+
+
+@lru_cache(maxsize=64)
+def format_second(seconds: int) -> str:
+    """ISO 8601 UTC time of a second since the epoch, cached since consecutive log lines share it"""
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+
+
+def json_string(value: str | None) -> str:
+    """JSON literal of an optional string"""
+    return encode_basestring_ascii(value) if value is not None else "null"
+
+
+class AccessLog:
+    """Access log written by a background thread in batches once per flush interval, request handling only enqueues
+    timings so that formatting and writing never delay a response"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = queue.SimpleQueue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="access-log", daemon=True)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.thread.start()
+
+    def write(self, timing: RequestTiming) -> None:
+        """Queue a request for the log without blocking"""
+        self.records.put(timing)
+
+    def run(self) -> None:
+        """Flush the queued records every interval until the log is closed"""
+        while not self.stopped.wait(access_log_flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        """Write all queued records with one append per batch"""
+        while not self.records.empty():
+            batch = []
+            while len(batch) < access_log_batch_size and not self.records.empty():
+                batch.append(self.records.get_nowait().to_json())
+            batch.append("")
+            try:
+                os.write(self.fd, "\n".join(batch).encode())
+            except OSError as e:
+                logging.error("Writing the access log %s failed: %s", self.path, e)
+
+    def close(self) -> None:
+        """Write the remaining records and close the log file"""
+        self.stopped.set()
+        self.thread.join()
+        os.close(self.fd)
+
+
+class Histogram:
+    """Cumulative histogram of durations in seconds with fixed bucket bounds"""
+
+    def __init__(self, buckets: tuple[float, ...] = latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Count one value, the caller holds the metrics lock"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name: str, description: str, labels: str = "") -> list[str]:
+        """Lines of the histogram in the Prometheus text format, labels are added to every sample"""
+        lines = [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+        separator = "," if labels else ""
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_sum{braced(labels)} {self.sum:.6f}")
+        lines.append(f"{name}_count{braced(labels)} {cumulative}")
+        return lines
+
+
+class Metrics:
+    """Request counters and latency histograms of one server process. Pre-forked workers each count only the
+    connections the kernel gave them, so their samples carry a worker label with the process id and every scrape
+    returns the values of the worker that accepted it"""
+
+    def __init__(self, worker: int | None = None):
+        self.labels = f'worker="{worker}"' if worker is not None else ""
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.bytes_sent = 0
+        self.request_duration = Histogram()
+        self.handler_duration = Histogram()
+        self.started = time.time()
+
+    def observe(self, timing: RequestTiming) -> None:
+        """Count a finished request"""
+        method = timing.method if timing.method in known_methods else "OTHER"
+        with self.lock:
+            key = (method, timing.status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes_sent += timing.size
+            self.request_duration.observe(timing.finished - timing.first_byte)
+            self.handler_duration.observe(timing.handled - timing.parsed)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format"""
+        with self.lock:
+            lines = ["# HELP http_requests_total Requests answered, by method and status",
+                     "# TYPE http_requests_total counter"]
+            prefix = f"{self.labels}," if self.labels else ""
+            for (method, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{{prefix}method="{method}",status="{status}"}} {count}')
+            lines += ["# HELP http_response_bytes_total Bytes sent in responses, heads included",
+                      "# TYPE http_response_bytes_total counter",
+                      f"http_response_bytes_total{braced(self.labels)} {self.bytes_sent}"]
+            lines += self.request_duration.render("http_request_duration_seconds",
+                                                  "Time from the first byte of a request to the last byte of its response",
+                                                  self.labels)
+            lines += self.handler_duration.render("http_handler_duration_seconds",
+                                                  "Time from a parsed request head to a ready response", self.labels)
+            lines += ["# HELP process_start_time_seconds Start time of the server process",
+                      "# TYPE process_start_time_seconds gauge",
+                      f"process_start_time_seconds{braced(self.labels)} {self.started:.3f}"]
+        return "\n".join(lines) + "\n"
+
+
+def braced(labels: str) -> str:
+    """Label set of a sample, empty without labels"""
+    return f"{{{labels}}}" if labels else ""
@@ -0,0 +1,77 @@
+import argparse
+import timeit
+
+from http_commons import RequestParser, extract_headers, nlc
+
+iterations = 100000
+repeats = 5
+
+browser_headers = [
+    "Host: localhost:8080",
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language: en-US,en;q=0.5",
+    "Accept-Encoding: gzip, deflate, br",
+    "Connection: keep-alive",
+    "Upgrade-Insecure-Requests: 1",
+    "If-Modified-Since: Fri, 26 May 2023 11:34:36 GMT",
+    'If-None-Match: "11e021-5-1762ae5194adf800"',
+    "Cache-Control: max-age=0",
+    "Sec-Fetch-Dest: document",
+    "Sec-Fetch-Mode: navigate",
+]
+
+
+def build_request(header_count: int) -> bytes:
+    """GET request with browser-like headers, padded with distinct custom fields to reach the header count"""
+    headers = browser_headers[:header_count] + [f"X-Custom-{index}: value {index}"
+                                                for index in range(header_count - len(browser_headers))]
+    return f"GET /index.html HTTP/1.1{nlc}{nlc.join(headers)}{nlc}{nlc}".encode()
+
+
+def parse_with_regex(data: bytes) -> tuple:
+    """Request parsing as done before the incremental parser: decode, split the request line, regex the headers"""
+    request = data.decode()
+    first_line_end = request.find(nlc)
+    method, uri, version = request[:first_line_end].split(" ")
+    headers, body = extract_headers(request[first_line_end + 2:])
+    return method, uri, version, headers
+
+
+def parse_incrementally(data: bytes) -> tuple:
+    """Request parsing by a fresh RequestParser, as for the first request of a connection"""
+    request = RequestParser().feed(data)[0]
+    return request.method, request.uri, request.version, request.headers
+
+
+def intact_fields(headers: dict[str, str], header_count: int) -> int:
+    """Header fields of the request whose value was parsed completely"""
+    fields = [line.partition(": ") for line in browser_headers[:header_count]]
+    return sum(1 for name, _, value in fields if headers.get(name) == value)
+
+
+def measure(parse, data: bytes, count: int) -> float:
+    """Best time per parse in microseconds"""
+    return min(timeit.repeat(lambda: parse(data), number=count, repeat=repeats)) / count * 1e6
+
+
+def main():
+    """Compare the regular expression and the incremental request parsers on the same request"""
+    parser = argparse.ArgumentParser(description="HTTP request parsing microbenchmark")
+    parser.add_argument("--iterations", type=int, default=iterations, help="parses per measurement")
+    parser.add_argument("--headers", type=int, default=len(browser_headers), help="header fields in the request")
+    args = parser.parse_args()
+    data = build_request(args.headers)
+    regex = measure(parse_with_regex, data, args.iterations)
+    incremental = measure(parse_incrementally, data, args.iterations)
+    print(f"request of {len(data)} bytes with {args.headers} header fields")
+    known = min(args.headers, len(browser_headers))
+    print(f"regex:       {regex:.2f} us per request, "
+          f"{intact_fields(parse_with_regex(data)[3], args.headers)} of {known} browser fields intact")
+    print(f"incremental: {incremental:.2f} us per request, "
+          f"{intact_fields(parse_incrementally(data)[3], args.headers)} of {known} browser fields intact")
+    print(f"speedup:     {regex / incremental:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
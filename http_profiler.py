@@ -0,0 +1,133 @@
+import logging
+import os
+import sys
+import threading
+import time
+from threading import get_ident
+
+profile_interval = 0.005
+profile_duration = 10.0
+profile_directory = "."
+max_stack_depth = 128
+
+sampling = False
+spans: dict[int, str] = {}
+frame_labels = {}
+last_profile: str | None = None
+profile_lock = threading.Lock()
+active_profiler = None
+started = time.time()
+
+
+def enter_span(name: str) -> None:
+    """Mark the phase the current thread is in, only recorded while a profile is being sampled.
+    Threads move from span to span, so no exit call is needed and asyncio tasks share the span of their thread"""
+    if sampling:
+        spans[get_ident()] = name
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads of the process at a fixed interval for a window of time and aggregates them
+    into collapsed stacks, one line of semicolon separated frames and a sample count per distinct stack"""
+
+    def __init__(self, duration: float, interval: float, path: str):
+        self.duration = duration
+        self.interval = interval
+        self.path = path
+        self.counts = {}
+        self.samples = 0
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def run(self) -> None:
+        """Sample until the window ends, then publish the collapsed stacks"""
+        global sampling, last_profile, active_profiler
+        own = get_ident()
+        deadline = time.monotonic() + self.duration
+        try:
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident != own:
+                        self.record(frame, spans.get(ident))
+                self.samples += 1
+                time.sleep(self.interval)
+        finally:
+            sampling = False
+            spans.clear()
+            last_profile = self.collapsed()
+            with profile_lock:
+                active_profiler = None
+        try:
+            with open(self.path, "w") as profile_file:
+                profile_file.write(last_profile)
+        except OSError as e:
+            logging.error("Writing the profile %s failed: %s", self.path, e)
+            return
+        logging.info("Profiled %d samples into %s", self.samples, self.path)
+
+    def record(self, frame, span: str | None) -> None:
+        """Count the stack of one thread, outermost frame first and prefixed with its span"""
+        labels = []
+        while frame is not None and len(labels) < max_stack_depth:
+            labels.append(frame_label(frame.f_code))
+            frame = frame.f_back
+        if span is not None:
+            labels.append(f"[{span}]")
+        labels.reverse()
+        stack = ";".join(labels)
+        self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def collapsed(self) -> str:
+        """Collapsed stacks as read by flamegraph.pl, speedscope and similar tools, most sampled first"""
+        ordered = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return "".join(f"{stack} {count}\n" for stack, count in ordered)
+
+
+def frame_label(code) -> str:
+    """Name of a function in a collapsed stack, cached per code object since it is computed for every frame"""
+    label = frame_labels.get(code)
+    if label is None:
+        label = frame_labels[code] = f"{os.path.basename(code.co_filename)}:{code.co_qualname}"
+    return label
+
+
+def latest_profile() -> str | None:
+    """Newest collapsed stacks written to the profile directory since this server started, by any of its processes.
+    Pre-forked workers only know their own last profile, while the one asked may not be the one that sampled"""
+    newest, newest_time = None, started
+    try:
+        with os.scandir(profile_directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("profile-") and entry.name.endswith(".folded"):
+                    modified = entry.stat().st_mtime
+                    if modified >= newest_time:
+                        newest, newest_time = entry.path, modified
+    except OSError as e:
+        logging.error("Listing the profile directory %s failed: %s", profile_directory, e)
+        return None
+    if newest is None:
+        return None
+    try:
+        with open(newest) as profile_file:
+            return profile_file.read()
+    except OSError as e:
+        logging.error("Reading the profile %s failed: %s", newest, e)
+        return None
+
+
+def start_profile(duration: float | None = None, interval: float | None = None) -> SamplingProfiler | None:
+    """Start sampling all threads into a new collapsed stacks file, None if a profile is already running.
+    Never blocks, so that it can be called from a signal handler"""
+    global sampling, active_profiler
+    if not profile_lock.acquire(blocking=False):
+        return None
+    try:
+        if active_profiler is not None:
+            return None
+        name = f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        active_profiler = SamplingProfiler(duration or profile_duration, interval or profile_interval,
+                                           os.path.join(profile_directory, name))
+        sampling = True
+        active_profiler.thread.start()
+        return active_profiler
+    finally:
+        profile_lock.release()
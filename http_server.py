@@ -1,95 +1,654 @@
+import argparse
+import asyncio
+import heapq
+import inspect
+import io
+import itertools
 import logging
+import math
+import os
 import os.path
+import queue
+import selectors
 import signal
 import socket
+import subprocess
+import sys
+import tempfile
 import threading
 import time
-from datetime import datetime
+import tomllib
+import zlib
+from collections import deque
+from email.utils import mktime_tz, parsedate_tz
+from functools import lru_cache, partial
 from threading import Thread
+from typing import AsyncIterable, AsyncIterator, Awaitable, BinaryIO, Callable, Iterable, Iterator
+from urllib.parse import parse_qs, unquote, urlsplit
 
 import select
 
-from http_commons import extract_headers, nlc, to_bytes
+import http_profiler
+from http_commons import HttpError, ReceiveBuffer, Request, RequestParser, corked, nlc, to_bytes, \
+    tune_listening_socket, tune_socket
+from http_file_cache import CachedFile, DirectoryIndex, FileCache, VariantCache
+from http_file_writer import FileWriter, fsync_policies
+from http_metrics import AccessLog, Metrics, RequestTiming
+from http_profiler import enter_span, start_profile
 
 host_port = 8080
-max_buffer_size = 1024
+bind_address = ""
+max_buffer_size = 256 * 1024
+tcp_no_delay = True
+tcp_cork = False
+tcp_defer_accept = None
+tcp_fast_open = None
+socket_send_buffer = None
+socket_receive_buffer = None
+response_chunk_size = 64 * 1024
+sendfile_slice_size = 1024 * 1024
+max_send_buffers = 1024
+listen_backlog = 128
+concurrency_models = ("threaded", "event_loop", "pool", "asyncio")
+concurrency_model = "threaded"
+worker_pool_size = 16
+worker_queue_size = 64
+worker_processes = 0
+file_cache_max_bytes = 64 * 1024 * 1024
+file_cache_max_file_size = 256 * 1024
+file_cache_revalidate_interval = 1.0
+document_root = "server_files"
+index_files = ("index.html",)
+directory_rescan_interval = 2.0
+etag_content_hash = False
+compression_min_size = 1024
+compression_level = 6
+compressed_cache_max_bytes = 16 * 1024 * 1024
+compressed_cache_max_file_size = 1024 * 1024
+default_cache_control = "no-cache"
+max_request_body_size = 64 * 1024 * 1024
+max_request_line_size = 8 * 1024
+max_header_count = 100
+max_header_size = 64 * 1024
+supported_versions = ("HTTP/1.1", "HTTP/1.0")
+upload_chunk_size = 64 * 1024
+upload_prefix = ".upload-"
+fsync_policy = "none"
+fsync_interval = 1.0
+max_open_append_files = 64
+max_ranges = 16
+keep_alive_timeout = 5.0
+max_keep_alive_requests = 100
+request_header_timeout = 10.0
+request_body_timeout = 30.0
+send_timeout = 30.0
+supervisor_poll_interval = 0.2
+worker_restart_delay = 1.0
+worker_shutdown_timeout = 30.0
+drain_timeout = 10.0
+drain_poll_interval = 0.05
+drain_cleanup_timeout = 1.0
+reload_timeout = 10.0
+listen_fd_variable = "HTTP_SERVER_LISTEN_FD"
+ready_fd_variable = "HTTP_SERVER_READY_FD"
+access_log_path = None
+metrics_path = None
+profile_path = None
+max_profile_factor = 10
+
+ResponseBody = bytes | BinaryIO | Iterable[bytes] | AsyncIterable[bytes] | None
+Response = tuple[int, dict[str, any], ResponseBody]
+Handler = Callable[[Request], Response | Awaitable[Response]]
+
+routes: dict[tuple[str, str], Handler] = {}
+
+status_reasons = {
+    200: "Success",
+    201: "Created",
+    202: "Accepted",
+    204: "No Content",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    409: "Conflict",
+    411: "Length Required",
+    412: "Precondition Failed",
+    413: "Payload Too Large",
+    414: "URI Too Long",
+    416: "Range Not Satisfiable",
+    431: "Request Header Fields Too Large",
+    500: "Server Error",
+    501: "Not Implemented",
+    503: "Service Unavailable",
+}
+status_lines = {status: f"HTTP/1.1 {status} {reason}{nlc}".encode() for status, reason in status_reasons.items()}
+
+default_media_type = "application/octet-stream"
+media_types = {
+    ".html": "text/html",
+    ".htm": "text/html",
+    ".css": "text/css",
+    ".js": "text/javascript",
+    ".mjs": "text/javascript",
+    ".txt": "text/plain",
+    ".csv": "text/csv",
+    ".md": "text/markdown",
+    ".xml": "application/xml",
+    ".json": "application/json",
+    ".map": "application/json",
+    ".webmanifest": "application/manifest+json",
+    ".wasm": "application/wasm",
+    ".pdf": "application/pdf",
+    ".zip": "application/zip",
+    ".gz": "application/gzip",
+    ".tar": "application/x-tar",
+    ".bin": "application/octet-stream",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".avif": "image/avif",
+    ".bmp": "image/bmp",
+    ".svg": "image/svg+xml",
+    ".ico": "image/x-icon",
+    ".mp3": "audio/mpeg",
+    ".ogg": "audio/ogg",
+    ".wav": "audio/wav",
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+    ".woff": "font/woff",
+    ".woff2": "font/woff2",
+    ".ttf": "font/ttf",
+    ".otf": "font/otf",
+}
+
+compressible_media_types = {
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "application/wasm",
+    "application/xml",
+    "image/svg+xml",
+}
+cache_control_policies: dict[str, str] = {}
+date_cache = (0, "")
+access_log: AccessLog | None = None
+metrics: Metrics | None = None
+instrumented = False
 
 # logging.basicConfig(level=logging.DEBUG)
 
 
 def start_server():
     """Setup listening socket, start waiting for connections"""
+    if worker_processes > 0:
+        start_prefork_server()
+        return
+    server_socket = inherited_server_socket() or create_server_socket()
+    if server_socket is None:
+        return
+    install_reload_handler(server_socket)
+    notify_ready()
+    serve(server_socket)
+
+
+def create_server_socket(reuse_port: bool = False) -> socket:
+    """Create, bind and listen on the server socket, optionally shared with other processes through SO_REUSEPORT"""
     try:
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         logging.debug("Socket successfully created.")
     except socket.error as err:
         logging.error(f"Socket creation failed with error {err}.")
-        return
-    server_socket.bind(('', host_port))
-    server_socket.listen()
+        return None
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    tune_socket(server_socket, tcp_no_delay, socket_send_buffer, socket_receive_buffer)
+    tune_listening_socket(server_socket, tcp_defer_accept, tcp_fast_open)
+    server_socket.bind((bind_address, host_port))
+    server_socket.listen(listen_backlog)
     logging.debug("Socket is listening...")
-    await_connections(server_socket)
+    return server_socket
+
+
+def inherited_server_socket() -> socket.socket | None:
+    """Listening socket handed over by the process this one replaces, None if there is none or the address changed"""
+    fd = os.environ.pop(listen_fd_variable, None)
+    if fd is None:
+        return None
+    server_socket = socket.socket(fileno=int(fd))
+    if server_socket.getsockname() != (bind_address or "0.0.0.0", host_port):
+        logging.info("Listen address changed, not taking over %s", server_socket.getsockname())
+        server_socket.close()
+        return None
+    tune_socket(server_socket, tcp_no_delay, socket_send_buffer, socket_receive_buffer)
+    tune_listening_socket(server_socket, tcp_defer_accept, tcp_fast_open)
+    server_socket.listen(listen_backlog)
+    logging.debug("Took over the listening socket")
+    return server_socket
+
+
+def notify_ready() -> None:
+    """Tell the process this one replaces that connections are accepted now"""
+    fd = os.environ.pop(ready_fd_variable, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"1")
+    except OSError as e:
+        logging.debug("Notifying the replaced process failed, another worker may have done so: %s", e)
+    finally:
+        os.close(int(fd))
+
+
+def install_reload_handler(server_socket: socket.socket | None) -> None:
+    """On SIGHUP start a new process with the same command line, which reads the configuration again and starts with
+    empty caches, and drain this one once the new process accepts connections"""
+    if not hasattr(signal, "SIGHUP"):
+        return
+    reloading = threading.Lock()
+
+    def reload():
+        try:
+            if start_successor(server_socket):
+                logging.info("Reloaded, draining the connections of the replaced process")
+                os.kill(os.getpid(), signal.SIGTERM)
+            else:
+                logging.error("The new process did not start accepting connections, reload aborted")
+        finally:
+            reloading.release()
+
+    def reload_handler(signum, frame):
+        """Reload in a thread, since starting the new process may take a while"""
+        if not reloading.acquire(blocking=False):
+            logging.warning("Reload signal received while reloading, ignoring it")
+            return
+        logging.info("Reload signal received, starting a new process")
+        Thread(target=reload, name="reload", daemon=True).start()
+
+    signal.signal(signal.SIGHUP, reload_handler)
+
+
+def start_successor(server_socket: socket.socket | None) -> bool:
+    """Start this server again, handing over the listening socket if given, and wait until the new process accepts
+    connections. Returns False and stops the new process if it did not within the reload timeout"""
+    ready_read, ready_write = os.pipe()
+    environment = dict(os.environ)
+    environment[ready_fd_variable] = str(ready_write)
+    pass_fds = [ready_write]
+    if server_socket is not None:
+        environment[listen_fd_variable] = str(server_socket.fileno())
+        pass_fds.append(server_socket.fileno())
+    try:
+        process = subprocess.Popen([sys.executable, *sys.orig_argv[1:]], env=environment, pass_fds=pass_fds)
+    except OSError as e:
+        logging.error("Starting the new process failed: %s", e)
+        os.close(ready_read)
+        return False
+    finally:
+        os.close(ready_write)
+    try:
+        readable, _, _ = select.select([ready_read], [], [], reload_timeout)
+        ready = bool(readable) and os.read(ready_read, 1) == b"1"
+    finally:
+        os.close(ready_read)
+    if not ready:
+        process.kill()
+    return ready
+
+
+def serve(server_socket: socket):
+    """Wait for connections on the server socket with the configured concurrency model"""
+    start_instrumentation()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, profile_signal_handler)
+    try:
+        if concurrency_model == "event_loop":
+            await_connections_event_loop(server_socket)
+        elif concurrency_model == "pool":
+            await_connections_pool(server_socket)
+        elif concurrency_model == "asyncio":
+            await_connections_asyncio(server_socket)
+        else:
+            await_connections(server_socket)
+    finally:
+        file_writer.close()
+        stop_instrumentation()
+
+
+def start_instrumentation() -> None:
+    """Open the access log and enable the metrics endpoint of this process if they are configured"""
+    global access_log, metrics, instrumented
+    if access_log_path:
+        access_log = AccessLog(access_log_path)
+    if metrics_path:
+        metrics = Metrics(os.getpid() if worker_processes > 1 else None)
+        routes[("GET", metrics_path)] = metrics_endpoint
+    if profile_path:
+        routes[("GET", profile_path)] = routes[("POST", profile_path)] = profile_endpoint
+    instrumented = access_log is not None or metrics is not None
+
+
+def stop_instrumentation() -> None:
+    """Stop recording requests and flush the access log"""
+    global access_log, instrumented
+    instrumented = False
+    if access_log is not None:
+        access_log.close()
+        access_log = None
+
+
+def metrics_endpoint(request: Request) -> Response:
+    """Request counters and latency histograms of this process in the Prometheus text format, with --processes
+    only those of the worker that accepted the connection, labelled with its process id"""
+    headers = {"Date": current_date(), "Content-Type": "text/plain; version=0.0.4", "Cache-Control": "no-store"}
+    return 200, headers, metrics.render().encode()
+
+
+def profile_signal_handler(signum, frame):
+    """Sample the stacks of all threads of this process for the configured profile window"""
+    if start_profile() is None:
+        logging.warning("Profile signal received while a profile is running, ignoring it")
+
+
+def profile_endpoint(request: Request) -> Response:
+    """POST starts sampling this process, for ?seconds=N if given and capped at max_profile_factor times the default
+    duration, GET returns the last collapsed stacks, with --processes the newest written by any worker"""
+    headers = {"Date": current_date(), "Content-Type": "text/plain", "Cache-Control": "no-store"}
+    if request.method == "GET":
+        profile = http_profiler.latest_profile() if worker_processes > 1 else http_profiler.last_profile
+        if profile is None:
+            return 404, headers, b"No profile has been taken yet\n"
+        return 200, headers, profile.encode()
+    try:
+        seconds = float(parse_qs(urlsplit(request.uri).query).get("seconds", ["0"])[0])
+    except ValueError:
+        return bad_request_response()
+    if not math.isfinite(seconds):
+        return bad_request_response()
+    seconds = min(seconds, max_profile_factor * http_profiler.profile_duration)
+    profiler = start_profile(seconds if seconds > 0 else None)
+    if profiler is None:
+        return 409, headers, b"A profile is already running\n"
+    return 202, headers, f"Sampling for {profiler.duration:g}s into {profiler.path}\n".encode()
+
+
+def start_prefork_server():
+    """Run worker processes that accept on the same port and restart them when they die"""
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    shared_socket = None if reuse_port else inherited_server_socket() or create_server_socket()
+    workers = {}
+    stopping = False
+    stop_deadline = None
+
+    def spawn_worker(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if hasattr(signal, "SIGHUP"):
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            exit_code = 1
+            try:
+                server_socket = shared_socket or create_server_socket(reuse_port=True)
+                if server_socket is not None:
+                    notify_ready()
+                    serve(server_socket)
+                    exit_code = 0
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                logging.error(f"Worker process {index} failed: {e}")
+            finally:
+                os._exit(exit_code)
+        logging.debug("Started worker process %s with pid %s", index, pid)
+        workers[pid] = index
+
+    def interrupt_handler(signum, frame):
+        """Ask all workers to drain their connections and exit"""
+        nonlocal stopping, stop_deadline
+        logging.debug("Interrupt signal received, stopping worker processes")
+        stopping = True
+        stop_deadline = time.monotonic() + worker_shutdown_timeout
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    def profile_handler(signum, frame):
+        """Let every worker sample its own stacks"""
+        for pid in workers:
+            os.kill(pid, signal.SIGUSR1)
+
+    signal.signal(signal.SIGINT, interrupt_handler)
+    signal.signal(signal.SIGTERM, interrupt_handler)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, profile_handler)
+
+    install_reload_handler(shared_socket)
+
+    for index in range(worker_processes):
+        spawn_worker(index)
+    ready_fd = os.environ.pop(ready_fd_variable, None)
+    if ready_fd is not None:
+        os.close(int(ready_fd))
+
+    while workers:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if stop_deadline is not None and time.monotonic() > stop_deadline:
+                logging.error(f"Worker processes {list(workers)} did not stop in time, killing them")
+                for pid in workers:
+                    os.kill(pid, signal.SIGKILL)
+                stop_deadline = None
+            time.sleep(supervisor_poll_interval)
+            continue
+        index = workers.pop(pid, None)
+        if index is None:
+            continue
+        if not stopping:
+            logging.error(f"Worker process {index} ({pid}) exited with status {status}, restarting")
+            time.sleep(worker_restart_delay)
+            spawn_worker(index)
+    logging.debug("All worker processes stopped")
+    if shared_socket is not None:
+        shared_socket.close()
+    exit(1)
 
 
 def await_connections(server_socket: socket):
     """Handle incoming connections, keep track of active connections through threads"""
 
     def interrupt_handler(signum, frame):
-        """Wait for all connection threads to shut down"""
-        logging.debug("Interrupt signal received")
-        while threading.active_count() > 1:
-            logging.debug(f"Waiting for {threading.active_count() - 1} threads to finish")
-            time.sleep(1)
-        logging.debug("Closing server socket")
+        """Stop accepting and let the connection threads finish their requests until the drain deadline"""
+        logging.debug("Interrupt signal received, closing server socket")
         server_socket.close()
-        logging.debug("Server socket closed")
+        lifecycle.drain(drain_timeout)
+        drain_connections()
         exit(1)
 
     signal.signal(signal.SIGINT, interrupt_handler)
+    signal.signal(signal.SIGTERM, interrupt_handler)
 
     while True:
         readable, _, _ = select.select([server_socket], [], [], 1.0)
         if server_socket in readable:
             client, address = server_socket.accept()
-            logging.debug(f"Connected to: {address[0]}:{address[1]}")
-            thread = Thread(target=client_connection_handler_thread, args=[client])
+            logging.debug("Connected to: %s:%s", address[0], address[1])
+            thread = Thread(target=client_connection_handler_thread, args=[client], daemon=True)
             thread.start()
 
 
+def drain_connections() -> None:
+    """Wait for the registered connections to close, closing those still open at the drain deadline"""
+    if not lifecycle.wait(lifecycle.deadline):
+        logging.warning("Closing %d connections still open at the drain deadline", len(lifecycle.connections))
+        lifecycle.close_all()
+        lifecycle.wait(time.monotonic() + drain_cleanup_timeout)
+    logging.debug("Connections drained")
+
+
+def await_connections_pool(server_socket: socket):
+    """Hand incoming connections to a fixed size worker pool, shed load once its queue is full"""
+    pool = WorkerPool(worker_pool_size, worker_queue_size)
+    pool.start()
+
+    def interrupt_handler(signum, frame):
+        """Stop accepting and let the workers finish their connections until the drain deadline"""
+        logging.debug("Interrupt signal received, closing server socket")
+        server_socket.close()
+        lifecycle.drain(drain_timeout)
+        if not pool.shutdown(lifecycle.deadline):
+            drain_connections()
+        logging.debug("Worker pool stopped: %s", pool.metrics())
+        exit(1)
+
+    signal.signal(signal.SIGINT, interrupt_handler)
+    signal.signal(signal.SIGTERM, interrupt_handler)
+
+    while True:
+        readable, _, _ = select.select([server_socket], [], [], 1.0)
+        if server_socket in readable:
+            client, address = server_socket.accept()
+            logging.debug("Connected to: %s:%s", address[0], address[1])
+            if not pool.submit(client):
+                reject_connection(client)
+        else:
+            logging.debug("Worker pool: %s", pool.metrics())
+
+
+class WorkerPool:
+    """Fixed number of worker threads serving accepted sockets from a bounded queue"""
+
+    def __init__(self, size: int, queue_size: int):
+        self.size = size
+        self.connections = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        """Start the worker threads"""
+        for index in range(self.size):
+            worker = Thread(target=self.work, name=f"worker-{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, client_socket: socket) -> bool:
+        """Queue a connection for the workers, returns False when the queue is full"""
+        try:
+            self.connections.put_nowait(client_socket)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+
+    def work(self) -> None:
+        """Serve queued connections until a None sentinel is received"""
+        while True:
+            client_socket = self.connections.get()
+            if client_socket is None:
+                return
+            with self.lock:
+                self.active += 1
+            try:
+                client_connection_handler_thread(client_socket)
+            except Exception as e:
+                logging.debug("Worker connection ended with exception: %s", e)
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+    def shutdown(self, deadline: float | None = None) -> bool:
+        """Let the workers finish the queued connections and wait for them to stop, returns whether they all stopped
+        before the deadline"""
+        for _ in self.workers:
+            self.connections.put(None)
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        return not any(worker.is_alive() for worker in self.workers)
+
+    def metrics(self) -> dict[str, int]:
+        """Snapshot of the pool counters"""
+        with self.lock:
+            return {
+                "workers": self.size,
+                "queued": self.connections.qsize(),
+                "active": self.active,
+                "rejected": self.rejected,
+            }
+
+
+def reject_connection(client_socket: socket) -> None:
+    """Answer an overloaded connection with a 503 without waiting on the client"""
+    logging.debug("Worker queue full, rejecting connection")
+    try:
+        client_socket.setblocking(False)
+        client_socket.send(serialize_response(*service_unavailable_response()))
+    except OSError:
+        pass
+    finally:
+        client_socket.close()
+
+
 def client_connection_handler_thread(client_socket: socket):
     """Handling of opened connections and any HTTP messages received within a thread"""
-    logging.debug(f"Thread started: connected to {client_socket.getpeername()}")
+    logging.debug("Thread started")
+    parser = new_request_parser()
+    receiver = ReceiveBuffer(max_buffer_size)
+    state = ConnectionState(time.monotonic())
+    lifecycle.register(client_socket, state, partial(shutdown_socket, client_socket))
     try:
+        if instrumented:
+            state.peer = format_peer(client_socket.getpeername())
         while True:
             logging.debug("Receiving data from client")
-            data = client_socket.recv(max_buffer_size)
+            enter_span("receive")
+            client_socket.settimeout(max(state.deadline - time.monotonic(), 0.001))
+            state.reading = True
+            if state.waiting_for_request() and lifecycle.draining:
+                logging.debug("Closing idle connection while draining")
+                break
+            try:
+                data = receiver.receive(client_socket)
+            except socket.timeout:
+                logging.debug("Connection timed out while %s", state.phase)
+                if state.phase != "idle":
+                    client_socket.settimeout(send_timeout)
+                    send_response(client_socket, *closing_response(*request_timeout_response()))
+                break
+            state.reading = False
             if not data:
                 logging.debug("No data received from socket, indicating connection was closed from client side")
                 break
-            elif data:
-                request = data.decode('utf-8')  # decode the bytes received from the socket into a str
-                method, _, _, remainder = extract_request_line(request)
-                mode = 0
-                if method == "PUT" or method == "POST":
-                    mode = 1
-                if mode == 0:
-                    while not request.endswith('\r\n\r\n'):
-                        """until two newlines are received (signifying the end of the HTTP request) 
-                        we keep pulling data from the socket"""
-                        logging.debug("Request didn't end with 2 newline characters, receiving more data.")
-                        data = client_socket.recv(max_buffer_size)
-                        request += data.decode('utf-8')
-                elif mode == 1:
-                    logging.debug("Fetching data until all is received according to Content-Length header")
-                    headers, remainder = extract_headers(remainder)
-                    content_length = headers["Content-Length"]
-                    while len(remainder) != int(content_length):
-                        data = client_socket.recv(max_buffer_size)
-                        data = data.decode('utf-8')
-                        request += data
-                        remainder += data
-                logging.debug("Received full request")
-                handle_request(client_socket, request)
+            client_socket.settimeout(send_timeout)
+            if instrumented:
+                state.receiving(parser, time.monotonic())
+            enter_span("parse")
+            keep_alive = True
+            requests = parser.feed(data)
+            handled = 0
+            try:
+                for request in requests:
+                    logging.debug("Received full request")
+                    handled += 1
+                    keep_alive = handle_request(client_socket, request, state)
+                    if not keep_alive:
+                        break
+            finally:
+                discard_uploads(requests[handled:])
+            if not keep_alive:
+                break
+            parser.raise_pending()
+            state.received(parser, time.monotonic())
+    except HttpError as e:
+        logging.debug("Rejecting malformed request: %s", e)
+        send_response(client_socket, *closing_response(*error_response(e.status)))
+    except ConnectionError as e:
+        logging.debug("Connection lost: %s", e)
     except Exception as e:
         logging.error("Exception caught: %s", e)
         headers = server_error_headers()
@@ -97,136 +656,1221 @@ def client_connection_handler_thread(client_socket: socket):
         send_response(client_socket, 500, headers, body)
         raise
     finally:
-        logging.debug(f"Shutdown thread: connected to {client_socket.getpeername()}")
-        client_socket.shutdown(socket.SHUT_RDWR)
+        if parser.request is not None:
+            discard_upload(parser.request)
+        logging.debug("Shutdown thread")
+        shutdown_socket(client_socket)
         client_socket.close()
-        logging.debug(f"Shutdown thread done")
+        lifecycle.unregister(client_socket)
+        logging.debug("Shutdown thread done")
+
+
+def shutdown_socket(client_socket: socket) -> None:
+    """Shut down both directions of a connection, which also wakes a thread blocked reading from it"""
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class ConnectionState:
+    """Lifecycle of a persistent connection: requests served and the deadline of what it is currently doing"""
+
+    def __init__(self, now: float, peer: str | None = None):
+        self.requests = 0
+        self.phase = "idle"
+        self.deadline = now + keep_alive_timeout
+        self.accepted = now
+        self.first_byte = now
+        self.peer = peer
+        self.reading = False
+
+    def receiving(self, parser: RequestParser, now: float) -> None:
+        """Remember when the first byte of a request arrived, called before data is fed to the parser"""
+        if parser.phase() == "idle":
+            self.first_byte = now
+
+    def received(self, parser: RequestParser, now: float) -> None:
+        """Move the deadline after data was received, a request head only gets one deadline to arrive completely"""
+        phase = parser.phase()
+        if phase == "idle":
+            self.deadline = now + keep_alive_timeout
+        elif phase == "body":
+            self.deadline = now + request_body_timeout
+        elif self.phase != "head":
+            self.deadline = now + request_header_timeout
+        self.phase = phase
+
+    def sending(self, now: float) -> None:
+        """Move the deadline after response data was sent"""
+        self.phase = "sending"
+        self.deadline = now + send_timeout
+
+    def waiting_for_request(self) -> bool:
+        """Check whether a served connection is idle between requests, so that closing it loses no request.
+        Fresh connections are left to their keep-alive timeout since their first request may already be on its way"""
+        return self.phase == "idle" and self.requests > 0
+
+
+class Lifecycle:
+    """Open connections of this process and whether it is draining them before it exits. While draining, responses
+    close their connection and idle connections are closed, in-flight requests have until the deadline to finish"""
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.draining = False
+        self.deadline = None
+
+    def register(self, key, state: ConnectionState, close: Callable[[], None]) -> None:
+        """Track an open connection and how to close it from another thread or task"""
+        with self.lock:
+            self.connections[key] = (state, close)
+
+    def unregister(self, key) -> None:
+        """Forget a closed connection"""
+        with self.lock:
+            self.connections.pop(key, None)
+
+    def drain(self, timeout: float) -> None:
+        """Start draining and close the connections blocked waiting for their next request"""
+        if not self.draining:
+            self.deadline = time.monotonic() + timeout
+            self.draining = True
+        for state, close in self.snapshot():
+            if state.reading and state.waiting_for_request():
+                close()
+
+    def wait(self, deadline: float) -> bool:
+        """Wait until all connections closed or the deadline passed, returns whether they all closed"""
+        while self.connections and time.monotonic() < deadline:
+            time.sleep(drain_poll_interval)
+        return not self.connections
+
+    def close_all(self) -> None:
+        """Close all connections still open"""
+        for _, close in self.snapshot():
+            close()
+
+    def snapshot(self) -> list[tuple[ConnectionState, Callable[[], None]]]:
+        """Connections open right now, safe to iterate while they close"""
+        with self.lock:
+            return list(self.connections.values())
+
+
+def connection_headers(headers: dict[str, any], request: Request, state: ConnectionState,
+                       body: ResponseBody = None) -> bool:
+    """Add Connection and Keep-Alive headers to a response, returns whether the connection stays open.
+    Bodies of unknown size for HTTP/1.0 clients end with the connection, they can not decode chunked encoding"""
+    state.requests += 1
+    connection = request.headers.get("Connection", "").lower()
+    if request.version == "HTTP/1.0":
+        headers.pop("Transfer-Encoding", None)
+        requested = connection == "keep-alive" and (is_bytes_body(body) or is_file_body(body))
+    else:
+        requested = connection != "close"
+    keep_alive = (requested and state.requests < max_keep_alive_requests and headers.get("Connection") != "close"
+                  and not lifecycle.draining)
+    if keep_alive:
+        headers["Connection"] = "keep-alive"
+        headers["Keep-Alive"] = f"timeout={int(keep_alive_timeout)}, max={max_keep_alive_requests - state.requests}"
+    else:
+        headers["Connection"] = "close"
+    return keep_alive
+
+
+def stamp_parsed(request: Request) -> None:
+    """Remember when the head of a request was parsed"""
+    request.parsed_at = time.monotonic()
+
+
+def start_timing(request: Request, state: ConnectionState, status: int) -> RequestTiming:
+    """Timing of a request whose response is ready to be sent"""
+    return RequestTiming(state.peer, request.method, request.uri, request.version, status, 0, state.accepted,
+                         state.first_byte, request.parsed_at or state.first_byte, time.monotonic(), 0.0)
+
+
+def finish_timing(timing: RequestTiming, size: int) -> None:
+    """Complete the timing of a sent response and pass it to the metrics and the access log"""
+    timing.size = size
+    timing.finished = time.monotonic()
+    if metrics is not None:
+        metrics.observe(timing)
+    if access_log is not None:
+        access_log.write(timing)
+
+
+def format_peer(address: tuple | str | None) -> str | None:
+    """Client address as host:port"""
+    if isinstance(address, tuple):
+        return f"{address[0]}:{address[1]}"
+    return address or None
+
+
+def closing_response(status: int, headers: dict[str, any], body: ResponseBody) -> (int, dict[str, any], ResponseBody):
+    """Mark a response as the last one sent on its connection"""
+    headers["Connection"] = "close"
+    return status, headers, body
+
+
+def await_connections_asyncio(server_socket: socket):
+    """Serve all connections as asyncio tasks, which allows handlers and bodies to be asynchronous"""
+    asyncio.run(serve_asyncio(server_socket))
+    exit(1)
+
+
+async def serve_asyncio(server_socket: socket) -> None:
+    """Run the asyncio server until an interrupt or termination signal is received"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    tasks = set()
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        tasks.add(task)
+        try:
+            await asyncio_connection_handler(reader, writer)
+        finally:
+            tasks.discard(task)
+
+    server = await asyncio.start_server(handle_connection, sock=server_socket, backlog=listen_backlog)
+    async with server:
+        await stop.wait()
+        logging.debug("Interrupt signal received, closing server socket")
+        server.close()
+        lifecycle.drain(drain_timeout)
+        if tasks:
+            await asyncio.wait(list(tasks), timeout=max(lifecycle.deadline - time.monotonic(), 0))
+        if tasks:
+            logging.warning("Closing %d connections still open at the drain deadline", len(tasks))
+        for task in list(tasks):
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def asyncio_connection_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Handling of an opened connection and any HTTP messages received within an asyncio task"""
+    parser = new_request_parser()
+    state = ConnectionState(time.monotonic())
+    if instrumented:
+        state.peer = format_peer(writer.get_extra_info("peername"))
+    lifecycle.register(writer, state, asyncio.current_task().cancel)
+    try:
+        while True:
+            enter_span("receive")
+            state.reading = True
+            if state.waiting_for_request() and lifecycle.draining:
+                logging.debug("Closing idle connection while draining")
+                break
+            try:
+                data = await asyncio.wait_for(reader.read(max_buffer_size),
+                                              max(state.deadline - time.monotonic(), 0.001))
+            except asyncio.TimeoutError:
+                logging.debug("Connection timed out while %s", state.phase)
+                if state.phase != "idle":
+                    await send_response_async(writer, *closing_response(*request_timeout_response()))
+                break
+            state.reading = False
+            if not data:
+                logging.debug("No data received from socket, indicating connection was closed from client side")
+                break
+            if instrumented:
+                state.receiving(parser, time.monotonic())
+            enter_span("parse")
+            keep_alive = True
+            requests = parser.feed(data)
+            handled = 0
+            try:
+                for request in requests:
+                    logging.debug("Received full request")
+                    handled += 1
+                    enter_span("handle")
+                    status, headers, body = await process_request_async(request)
+                    keep_alive = connection_headers(headers, request, state, body)
+                    timing = start_timing(request, state, status) if instrumented else None
+                    enter_span("send")
+                    size = await send_response_async(writer, status, headers, body, supports_chunked(request))
+                    if timing is not None:
+                        finish_timing(timing, size)
+                    enter_span("parse")
+                    if not keep_alive:
+                        break
+            finally:
+                discard_uploads(requests[handled:])
+            if not keep_alive:
+                break
+            parser.raise_pending()
+            state.received(parser, time.monotonic())
+    except HttpError as e:
+        logging.debug("Rejecting malformed request: %s", e)
+        await send_response_async(writer, *closing_response(*error_response(e.status)))
+    except (ConnectionError, asyncio.TimeoutError) as e:
+        logging.debug("Connection lost: %s", e)
+    except asyncio.CancelledError:
+        logging.debug("Connection cancelled by server shutdown")
+    except Exception as e:
+        logging.error("Exception caught: %s", e)
+        await send_response_async(writer, 500, server_error_headers(), status_code_body(500))
+    finally:
+        lifecycle.unregister(writer)
+        if parser.request is not None:
+            discard_upload(parser.request)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, asyncio.CancelledError):
+            pass
+
+
+def await_connections_event_loop(server_socket: socket):
+    """Multiplex accepting, reading and writing of all connections in a single thread"""
+    loop = EventLoop(server_socket)
+
+    def interrupt_handler(signum, frame):
+        """Start draining, the loop stops accepting and closes connections once their responses are sent"""
+        logging.debug("Interrupt signal received, draining connections")
+        lifecycle.drain(drain_timeout)
+
+    signal.signal(signal.SIGINT, interrupt_handler)
+    signal.signal(signal.SIGTERM, interrupt_handler)
+    signal.set_wakeup_fd(loop.wake_socket.fileno())
+
+    while not lifecycle.draining or drain_event_loop(loop, server_socket):
+        enter_span("select")
+        timeout = 1.0
+        if loop.deadlines:
+            timeout = min(max(loop.deadlines[0][0] - time.monotonic(), 0), timeout)
+        if lifecycle.draining:
+            timeout = min(max(lifecycle.deadline - time.monotonic(), 0), timeout)
+        for key, mask in loop.selector.select(timeout=timeout):
+            if key.data is None:
+                accept_event_loop_connections(loop, server_socket)
+                continue
+            if key.data is loop.waker:
+                clear_event_loop_waker(loop)
+                continue
+            connection = key.data
+            if mask & selectors.EVENT_READ:
+                read_event_loop_connection(loop, connection)
+            if mask & selectors.EVENT_WRITE and not connection.closed:
+                write_event_loop_connection(loop, connection)
+        reap_event_loop_connections(loop)
+    for connection in loop.connections():
+        close_event_loop_connection(loop, connection)
+    signal.set_wakeup_fd(-1)
+    loop.selector.close()
+    logging.debug("Event loop stopped")
+    exit(1)
+
+
+class EventLoop:
+    """Selector of the event loop with the connection deadlines ordered in a heap"""
+
+    def __init__(self, server_socket: socket):
+        self.selector = selectors.DefaultSelector()
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ)
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.receiver = ReceiveBuffer(max_buffer_size, max_buffer_size)
+        self.waker, self.wake_socket = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_socket.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ, self.waker)
+
+    def connections(self) -> list["EventLoopConnection"]:
+        """Client connections registered with the selector"""
+        return [key.data for key in self.selector.get_map().values() if isinstance(key.data, EventLoopConnection)]
+
+
+class EventLoopConnection:
+    """State kept for a single connection handled by the event loop"""
+
+    def __init__(self, client_socket: socket, peer: str | None = None):
+        self.socket = client_socket
+        self.parser = new_request_parser()
+        self.state = ConnectionState(time.monotonic(), peer)
+        self.scheduled_deadline = None
+        self.events = selectors.EVENT_READ
+        self.output = deque()
+        self.closing = False
+        self.closed = False
+        self.sent = 0
+        self.recorded = 0
+
+
+class StreamTransfer:
+    """Body of unknown size that is still being sent to a non-blocking socket, with chunked encoding or delimited by
+    closing the connection"""
+
+    def __init__(self, body: BinaryIO | Iterable[bytes], chunked: bool = True):
+        self.body = body
+        self.chunks = iter_body_chunks(body)
+        self.chunked = chunked
+
+
+class FileTransfer:
+    """Part of a file that still has to be sent to a non-blocking socket"""
+
+    def __init__(self, file: BinaryIO, offset: int, remaining: int):
+        self.file = file
+        self.offset = offset
+        self.remaining = remaining
+
+
+def drain_event_loop(loop: EventLoop, server_socket: socket) -> bool:
+    """Stop accepting and close idle connections, returns whether connections remain to finish before the deadline"""
+    if server_socket.fileno() != -1:
+        logging.debug("Closing server socket")
+        loop.selector.unregister(server_socket)
+        server_socket.close()
+    for connection in loop.connections():
+        if connection.state.waiting_for_request() and not connection.output:
+            close_event_loop_connection(loop, connection)
+    remaining = len(loop.connections())
+    if remaining and time.monotonic() >= lifecycle.deadline:
+        logging.warning("Closing %d connections still open at the drain deadline", remaining)
+        return False
+    return remaining > 0
+
+
+def clear_event_loop_waker(loop: EventLoop) -> None:
+    """Discard the bytes written to the wakeup socket when a signal arrived during select"""
+    try:
+        while loop.waker.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
 
 
-def handle_request(client_socket: socket, request: str) -> None:
-    """Handles a complete HTTP request"""
-    (method, uri, version, remainder) = extract_request_line(request)
-    logging.debug(f"Extracted request line: {method} {uri} {version}")
-    request_headers, body = extract_headers(remainder)
-    logging.debug(f"Extracted request headers: {request_headers}")
-    if not (validate_version(version) or validate_request_headers(request_headers)):
-        response_status, response_headers, response_body = bad_request_response()
+def accept_event_loop_connections(loop: EventLoop, server_socket: socket) -> None:
+    """Accept all pending connections and register them for reading"""
+    while True:
+        try:
+            client, address = server_socket.accept()
+        except BlockingIOError:
+            return
+        logging.debug("Connected to: %s:%s", address[0], address[1])
+        client.setblocking(False)
+        connection = EventLoopConnection(client, format_peer(address) if instrumented else None)
+        loop.selector.register(client, connection.events, connection)
+        schedule_event_loop_deadline(loop, connection)
+
+
+def read_event_loop_connection(loop: EventLoop, connection: EventLoopConnection) -> None:
+    """Receive available data and queue a response for every complete request in the buffer"""
+    enter_span("receive")
+    try:
+        data = loop.receiver.receive(connection.socket)
+    except BlockingIOError:
+        return
+    except OSError as e:
+        logging.debug("Receiving failed, closing connection: %s", e)
+        close_event_loop_connection(loop, connection)
+        return
+    if not data:
+        logging.debug("No data received from socket, indicating connection was closed from client side")
+        connection.closing = True
     else:
-        logging.debug("Passed version and header validation")
-        if method == "HEAD":
-            response_status, response_headers, response_body = handle_head_request(uri, request_headers)
-        elif method == "GET":
-            response_status, response_headers, response_body = handle_get_request(uri, request_headers)
-        elif method == "PUT":
-            response_status, response_headers, response_body = handle_put_request(uri, body)
-        elif method == "POST":
-            response_status, response_headers, response_body = handle_post_request(uri, body)
+        if instrumented:
+            connection.state.receiving(connection.parser, time.monotonic())
+        enter_span("parse")
+        requests = []
+        handled = 0
+        try:
+            requests = connection.parser.feed(data)
+            for request in requests:
+                logging.debug("Received full request")
+                handled += 1
+                enter_span("handle")
+                status, headers, body = process_request(request)
+                if not connection_headers(headers, request, connection.state, body):
+                    connection.closing = True
+                timing = start_timing(request, connection.state, status) if instrumented else None
+                queue_response(connection, status, headers, body, supports_chunked(request))
+                if timing is not None:
+                    connection.output.append(timing)
+                enter_span("parse")
+                if connection.closing:
+                    break
+            else:
+                connection.parser.raise_pending()
+        except HttpError as e:
+            logging.debug("Rejecting malformed request: %s", e)
+            queue_response(connection, *closing_response(*error_response(e.status)))
+            connection.closing = True
+        except Exception as e:
+            logging.error("Exception caught: %s", e)
+            queue_response(connection, 500, server_error_headers(), status_code_body(500))
+            connection.closing = True
+        finally:
+            discard_uploads(requests[handled:])
+        if connection.output:
+            connection.state.sending(time.monotonic())
+        else:
+            connection.state.received(connection.parser, time.monotonic())
+    update_event_loop_interest(loop, connection)
+
+
+def reap_event_loop_connections(loop: EventLoop) -> None:
+    """Close connections whose deadline passed, answering 408 to clients that stalled in the middle of a request"""
+    now = time.monotonic()
+    while loop.deadlines and loop.deadlines[0][0] <= now:
+        deadline, _, connection = heapq.heappop(loop.deadlines)
+        if connection.closed or deadline != connection.state.deadline:
+            continue
+        logging.debug("Connection timed out while %s", connection.state.phase)
+        connection.scheduled_deadline = None
+        if connection.state.phase in ("head", "body") and not connection.output:
+            queue_response(connection, *closing_response(*request_timeout_response()))
+            connection.closing = True
+            connection.state.sending(now)
+            update_event_loop_interest(loop, connection)
         else:
-            response_status, response_headers, response_body = method_not_allowed_response()
-
-    send_response(client_socket, response_status, response_headers, response_body)
-
-
-def send_response(client_socket: socket, status: int, headers: dict[str, any], body: bytes) -> None:
-    response_line = f"HTTP/1.1 {map_status(status)}"
-    if body:
-        size = len(body)
-        if size > max_buffer_size * 10:
-            headers["transfer-coding"] = "chunked"
-            header_block = stringify_headers(headers)
-            response_start = to_bytes(response_line + nlc + header_block + nlc)
-            client_socket.sendall(response_start)
-            index = 0
-            while index < size:
-                left = index
-                right = (index + max_buffer_size) if size > index + max_buffer_size else size
-                body_part = body[left: right]
-                hexed = hex(len(body_part))
-                index = index + max_buffer_size
-                to_send = to_bytes(hexed + nlc) + body_part + to_bytes(nlc)
-                client_socket.sendall(to_send)
-            client_socket.sendall(to_bytes("0" + nlc))
+            close_event_loop_connection(loop, connection)
+
+
+def schedule_event_loop_deadline(loop: EventLoop, connection: EventLoopConnection) -> None:
+    """Push the current deadline of a connection on the heap, outdated entries are skipped when popped"""
+    if connection.state.deadline != connection.scheduled_deadline:
+        connection.scheduled_deadline = connection.state.deadline
+        heapq.heappush(loop.deadlines, (connection.state.deadline, next(loop.sequence), connection))
+
+
+def queue_response(connection: EventLoopConnection, status: int, headers: dict[str, any], body: ResponseBody,
+                   chunked: bool = True) -> None:
+    """Append a response to the pending output of a connection, files and streams are sent as the socket accepts"""
+    if is_bytes_body(body):
+        pending = bytearray(serialize_response(status, headers, body))
+        transfer = None
+    elif is_file_body(body):
+        file, offset, headers["Content-Length"] = file_body_span(body)
+        pending = bytearray(serialize_head(status, headers))
+        transfer = FileTransfer(file, offset, headers["Content-Length"])
+    else:
+        if chunked:
+            headers["Transfer-Encoding"] = "chunked"
+        pending = bytearray(serialize_head(status, headers))
+        transfer = StreamTransfer(body, chunked)
+    if connection.output and isinstance(connection.output[-1], bytearray):
+        connection.output[-1] += pending
+    else:
+        connection.output.append(pending)
+    if transfer is not None:
+        connection.output.append(transfer)
+
+
+def write_event_loop_connection(loop: EventLoop, connection: EventLoopConnection) -> None:
+    """Send as much of the pending output as the socket accepts"""
+    enter_span("send")
+    output = connection.output
+    try:
+        while output:
+            pending = output[0]
+            if isinstance(pending, RequestTiming):
+                output.popleft()
+                finish_timing(pending, connection.sent - connection.recorded)
+                connection.recorded = connection.sent
+                continue
+            if isinstance(pending, StreamTransfer):
+                framed, done = frame_chunks(pending.chunks, response_chunk_size, pending.chunked)
+                if done:
+                    output.popleft()
+                output.appendleft(framed)
+                continue
+            if isinstance(pending, FileTransfer):
+                sent = send_file_part(connection.socket, pending.file, pending.offset, pending.remaining)
+                if sent == 0:
+                    raise OSError("File ended before its announced Content-Length")
+                connection.state.sending(time.monotonic())
+                connection.sent += sent
+                pending.offset += sent
+                pending.remaining -= sent
+                if pending.remaining:
+                    continue
+                pending.file.close()
+            else:
+                sent = connection.socket.send(pending)
+                connection.state.sending(time.monotonic())
+                connection.sent += sent
+                del pending[:sent]
+                if pending:
+                    continue
+            output.popleft()
+    except BlockingIOError:
+        pass
+    except OSError as e:
+        logging.debug("Sending failed, closing connection: %s", e)
+        close_event_loop_connection(loop, connection)
+        return
+    if not output:
+        connection.state.received(connection.parser, time.monotonic())
+    update_event_loop_interest(loop, connection)
+
+
+def update_event_loop_interest(loop: EventLoop, connection: EventLoopConnection) -> None:
+    """Only wait for writability while output is pending, close once a closing connection is flushed"""
+    if connection.closing and not connection.output:
+        close_event_loop_connection(loop, connection)
+        return
+    events = selectors.EVENT_WRITE if connection.output else 0
+    if not connection.closing:
+        events |= selectors.EVENT_READ
+    if events != connection.events:
+        connection.events = events
+        loop.selector.modify(connection.socket, events, connection)
+    schedule_event_loop_deadline(loop, connection)
+
+
+def close_event_loop_connection(loop: EventLoop, connection: EventLoopConnection) -> None:
+    """Unregister and close a connection"""
+    if connection.closed:
+        return
+    connection.closed = True
+    loop.selector.unregister(connection.socket)
+    if connection.parser.request is not None:
+        discard_upload(connection.parser.request)
+    for pending in connection.output:
+        if isinstance(pending, FileTransfer):
+            pending.file.close()
+        elif isinstance(pending, StreamTransfer):
+            close_body(pending.body)
+    connection.output.clear()
+    try:
+        connection.socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    connection.socket.close()
+    logging.debug("Connection closed")
+
+
+def new_request_parser() -> RequestParser:
+    """Create the parser for a new connection, spooling upload bodies to disk and timing heads if instrumented"""
+    return RequestParser(max_request_body_size, open_upload_file, stamp_parsed if instrumented else None,
+                         max_request_line_size, max_header_count, max_header_size)
+
+
+def open_upload_file(request: Request) -> BinaryIO | None:
+    """Spool PUT and POST bodies into a temporary file next to their target, other bodies and those of routed
+    requests stay in memory. Targets in a missing directory are rejected with 404"""
+    if request.method != "PUT" and request.method != "POST":
+        return None
+    if (request.method, request.uri.split("?", 1)[0]) in routes:
+        return None
+    directory = os.path.dirname(map_uri(request.uri))
+    try:
+        return tempfile.NamedTemporaryFile(dir=directory, prefix=upload_prefix, delete=False,
+                                           buffering=upload_chunk_size)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HttpError(404, f"No directory to store {request.uri} in")
+
+
+def discard_upload(request: Request) -> None:
+    """Close and remove the spooled body of a request unless it was moved into place"""
+    if request.body_file is None:
+        return
+    request.body_file.close()
+    try:
+        os.remove(request.body_file.name)
+    except FileNotFoundError:
+        pass
+
+
+def discard_uploads(requests: list[Request]) -> None:
+    """Discard the spooled bodies of received requests that will not be handled because the connection closes"""
+    for request in requests:
+        discard_upload(request)
+
+
+def handle_request(client_socket: socket, request: Request, state: ConnectionState) -> bool:
+    """Handles a complete HTTP request, returns whether the connection stays open for the next one"""
+    enter_span("handle")
+    status, headers, body = process_request(request)
+    keep_alive = connection_headers(headers, request, state, body)
+    chunked = supports_chunked(request)
+    enter_span("send")
+    if instrumented:
+        timing = start_timing(request, state, status)
+        finish_timing(timing, send_response(client_socket, status, headers, body, chunked))
+    else:
+        send_response(client_socket, status, headers, body, chunked)
+    enter_span("parse")
+    return keep_alive
+
+
+def route(method: str, path: str) -> Callable[[Handler], Handler]:
+    """Register a handler, plain or async, for a method and path, the request body is only readable until it returns"""
+
+    def register(handler: Handler) -> Handler:
+        routes[(method, path)] = handler
+        return handler
+
+    return register
+
+
+def process_request(request: Request) -> Response:
+    """Handle a complete HTTP request and return the response, running async handlers to completion"""
+    response = dispatch_request(request)
+    if inspect.isawaitable(response):
+        response = asyncio.run(response)
+    return response
+
+
+async def process_request_async(request: Request) -> Response:
+    """Handle a complete HTTP request and return the response, awaiting async handlers. Spooled uploads are handled
+    in a thread, so that the event loop keeps serving while the file writer commits them"""
+    if request.body_file is not None:
+        response = await asyncio.to_thread(dispatch_request, request)
+    else:
+        response = dispatch_request(request)
+    if inspect.isawaitable(response):
+        response = await response
+    return response
+
+
+async def finish_async_response(response: Awaitable[Response], request: Request) -> Response:
+    """Await the response of an async handler before the request upload is discarded"""
+    try:
+        return await response
+    finally:
+        discard_upload(request)
+
+
+def dispatch_request(request: Request) -> Response | Awaitable[Response]:
+    """Dispatch a complete HTTP request to its registered or built-in handler"""
+    method, uri, version = request.method, request.uri, request.version
+    logging.debug("Extracted request line: %s %s %s", method, uri, version)
+    request_headers, body_file = request.headers, request.body_file
+    logging.debug("Extracted request headers: %s", request_headers)
+    handler = routes.get((method, uri.split("?", 1)[0]))
+    deferred = False
+    try:
+        if not (validate_version(version) and validate_request_headers(request_headers, version)):
+            response_status, response_headers, response_body = bad_request_response()
+        elif handler is not None:
+            response = handler(request)
+            if inspect.isawaitable(response):
+                deferred = True
+                return finish_async_response(response, request)
+            response_status, response_headers, response_body = response
         else:
-            headers["Content-Length"] = size
-            header_block = stringify_headers(headers)
-            response = to_bytes(response_line + nlc + header_block + nlc) + body
-            client_socket.sendall(response)
+            logging.debug("Passed version and header validation")
+            if method == "HEAD":
+                response_status, response_headers, response_body = handle_head_request(uri, request_headers)
+            elif method == "GET":
+                response_status, response_headers, response_body = handle_get_request(uri, request_headers)
+            elif method == "PUT":
+                response_status, response_headers, response_body = handle_put_request(uri, body_file)
+            elif method == "POST":
+                response_status, response_headers, response_body = handle_post_request(uri, body_file)
+            else:
+                response_status, response_headers, response_body = method_not_allowed_response()
+    finally:
+        if not deferred:
+            discard_upload(request)
+
+    return response_status, response_headers, response_body
+
+
+def send_response(client_socket: socket, status: int, headers: dict[str, any], body: ResponseBody,
+                  chunked: bool = True) -> int:
+    """Send a response, framing the body with Content-Length when its size is known and chunked otherwise, unless
+    chunked is False and closing the connection ends it. Returns the number of bytes sent"""
+    if is_bytes_body(body):
+        head = serialize_head(status, headers if body is None else with_content_length(headers, len(body)))
+        return send_buffers(client_socket, [head, body] if body else [head])
+    elif is_file_body(body):
+        try:
+            file, offset, headers["Content-Length"] = file_body_span(body)
+            head = serialize_head(status, headers)
+            with corked(client_socket, tcp_cork):
+                client_socket.sendall(head)
+                enter_span("sendfile")
+                send_file(client_socket, file, offset, headers["Content-Length"])
+            return len(head) + headers["Content-Length"]
+        finally:
+            body.close()
+    else:
+        if chunked:
+            headers["Transfer-Encoding"] = "chunked"
+        enter_span("stream")
+        return send_chunked(client_socket, serialize_head(status, headers), body, chunked)
+
+
+async def send_response_async(writer: asyncio.StreamWriter, status: int, headers: dict[str, any],
+                              body: ResponseBody, chunked: bool = True) -> int:
+    """Write a response to an asyncio stream, sending files with the event loop's sendfile support.
+    Returns the number of bytes written"""
+    if is_bytes_body(body):
+        message = serialize_response(status, headers, body)
+        writer.write(message)
+        size = len(message)
+    elif is_file_body(body):
+        try:
+            file, offset, headers["Content-Length"] = file_body_span(body)
+            head = serialize_head(status, headers)
+            writer.write(head)
+            await asyncio.wait_for(writer.drain(), send_timeout)
+            size = len(head) + await sendfile_async(writer, file, offset, headers["Content-Length"])
+        finally:
+            body.close()
     else:
-        header_block = stringify_headers(headers)
-        response = to_bytes(response_line + nlc + header_block + nlc)
-        client_socket.sendall(response)
+        if chunked:
+            headers["Transfer-Encoding"] = "chunked"
+        head = serialize_head(status, headers)
+        writer.write(head)
+        size = len(head)
+        try:
+            async for chunk in aiter_body_chunks(body):
+                if chunked:
+                    prefix = b"%x\r\n" % len(chunk)
+                    writer.writelines([prefix, chunk, b"\r\n"])
+                    size += len(prefix) + 2
+                else:
+                    writer.write(chunk)
+                size += len(chunk)
+                if writer.transport.get_write_buffer_size() >= response_chunk_size:
+                    await asyncio.wait_for(writer.drain(), send_timeout)
+        finally:
+            close_body(body)
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+            size += 5
+    await asyncio.wait_for(writer.drain(), send_timeout)
+    return size
+
+
+async def sendfile_async(writer: asyncio.StreamWriter, file: BinaryIO, offset: int, count: int) -> int:
+    """Send part of a file with the event loop's sendfile support in slices, each of which has to be accepted by the
+    client within send_timeout like every other write. Returns the number of bytes sent"""
+    loop = asyncio.get_running_loop()
+    sent = 0
+    while sent < count:
+        size = min(count - sent, sendfile_slice_size)
+        sliced = await asyncio.wait_for(loop.sendfile(writer.transport, file, offset + sent, size), send_timeout)
+        if sliced == 0:
+            raise OSError("File ended before its announced Content-Length")
+        sent += sliced
+    return sent
+
+
+def send_chunked(client_socket: socket, head: bytes, body: BinaryIO | Iterable[bytes], chunked: bool = True) -> int:
+    """Send a body of unknown size with chunked encoding, or as is when closing the connection ends it, gathering up
+    to response_chunk_size per system call. Returns the number of bytes sent"""
+    chunks = iter_body_chunks(body)
+    size = 0
+    try:
+        buffers = [head]
+        while True:
+            framed, done = frame_chunks(chunks, response_chunk_size, chunked)
+            buffers.append(framed)
+            size += send_buffers(client_socket, buffers)
+            if done:
+                return size
+            buffers = []
+    finally:
+        close_body(body)
+
+
+def send_buffers(client_socket: socket, buffers: list[bytes]) -> int:
+    """Send several buffers with a single scatter/gather system call where possible, returns the bytes sent"""
+    if not hasattr(client_socket, "sendmsg"):
+        message = b"".join(buffers)
+        client_socket.sendall(message)
+        return len(message)
+    size = sum(len(buffer) for buffer in buffers)
+    views = [memoryview(buffer) for buffer in buffers if buffer]
+    index = 0
+    while index < len(views):
+        sent = client_socket.sendmsg(views[index:index + max_send_buffers])
+        while index < len(views) and sent >= len(views[index]):
+            sent -= len(views[index])
+            index += 1
+        if sent:
+            views[index] = views[index][sent:]
+    return size
+
+
+def iter_body_chunks(body: BinaryIO | Iterable[bytes] | AsyncIterable[bytes]) -> Iterator[bytes]:
+    """Non empty chunks of a body of unknown size, file like bodies are read response_chunk_size at a time"""
+    if hasattr(body, "__aiter__"):
+        yield from iterate_async_body(body)
+    elif hasattr(body, "read"):
+        while chunk := body.read(response_chunk_size):
+            yield chunk
+    else:
+        for chunk in body:
+            if chunk:
+                yield chunk
+
+
+async def aiter_body_chunks(body: BinaryIO | Iterable[bytes] | AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """Non empty chunks of a body of unknown size, async iterators are awaited"""
+    if hasattr(body, "__aiter__"):
+        async for chunk in body:
+            if chunk:
+                yield chunk
+    else:
+        for chunk in iter_body_chunks(body):
+            yield chunk
+
+
+def iterate_async_body(body: AsyncIterable[bytes]) -> Iterator[bytes]:
+    """Iterate an async body from synchronous code on a private event loop"""
+    loop = asyncio.new_event_loop()
+    iterator = body.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+            if chunk:
+                yield chunk
+    finally:
+        loop.close()
+
+
+def frame_chunks(chunks: Iterator[bytes], limit: int, chunked: bool = True) -> (bytearray, bool):
+    """Encode chunks until at least limit bytes are framed, True once the last chunk has been added. Without chunked
+    encoding the chunks are only gathered"""
+    framed = bytearray()
+    for chunk in chunks:
+        if chunked:
+            framed += b"%x\r\n" % len(chunk)
+        framed += chunk
+        if chunked:
+            framed += b"\r\n"
+        if len(framed) >= limit:
+            return framed, False
+    if chunked:
+        framed += b"0\r\n\r\n"
+    return framed, True
+
+
+def close_body(body: ResponseBody) -> None:
+    """Release a streamed body, closing files and generators"""
+    if hasattr(body, "close"):
+        body.close()
+
+
+def send_file(client_socket: socket, file: BinaryIO, offset: int, count: int) -> None:
+    """Send part of a file on a blocking socket, copying in the kernel with os.sendfile where possible"""
+    if not hasattr(os, "sendfile") or client_socket.gettimeout() is not None:
+        client_socket.sendfile(file, offset, count)
+        return
+    while count > 0:
+        sent = os.sendfile(client_socket.fileno(), file.fileno(), offset, count)
+        if sent == 0:
+            raise OSError("File ended before its announced Content-Length")
+        offset += sent
+        count -= sent
+
+
+def send_file_part(client_socket: socket, file: BinaryIO, offset: int, count: int) -> int:
+    """Send as much of a file as a non-blocking socket accepts in one call"""
+    if hasattr(os, "sendfile"):
+        return os.sendfile(client_socket.fileno(), file.fileno(), offset, count)
+    data = os.pread(file.fileno(), min(count, max_buffer_size), offset)
+    return client_socket.send(data) if data else 0
+
+
+class FilePart:
+    """Byte range of an open file used as response body, sent from its offset without reading the rest"""
+
+    def __init__(self, file: BinaryIO, offset: int, size: int):
+        self.file = file
+        self.offset = offset
+        self.size = size
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read the next bytes of the range with pread"""
+        size = self.size if size < 0 else min(size, self.size)
+        data = os.pread(self.file.fileno(), size, self.offset)
+        self.offset += len(data)
+        self.size -= len(data)
+        return data
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def supports_chunked(request: Request) -> bool:
+    """Check whether the client can decode chunked response bodies, HTTP/1.0 clients can not"""
+    return request.version != "HTTP/1.0"
+
+
+def is_bytes_body(body: ResponseBody) -> bool:
+    """Check whether a response body is already in memory (or absent)"""
+    return body is None or isinstance(body, (bytes, bytearray))
+
+
+def is_file_body(body: ResponseBody) -> bool:
+    """Check whether a response body is an open file on disk that can be sent with sendfile"""
+    try:
+        return not is_bytes_body(body) and hasattr(body, "read") and body.fileno() >= 0
+    except (AttributeError, io.UnsupportedOperation):
+        return False
+
+
+def file_body_span(body: BinaryIO | FilePart) -> (BinaryIO, int, int):
+    """Open file, offset and length of a file body, whole files are sized from the descriptor itself"""
+    if isinstance(body, FilePart):
+        return body.file, body.offset, body.size
+    return body, 0, os.fstat(body.fileno()).st_size
+
+
+def serialize_head(status: int, headers: dict[str, any]) -> bytes:
+    """Build the response line and header block as bytes"""
+    return status_line(status) + to_bytes(stringify_headers(headers) + nlc)
+
+
+def serialize_response(status: int, headers: dict[str, any], body: bytes | None) -> bytes:
+    """Build the complete response message for a body that is in memory as bytes"""
+    if body is None:
+        return serialize_head(status, headers)
+    return serialize_head(status, with_content_length(headers, len(body))) + body
+
+
+def with_content_length(headers: dict[str, any], size: int) -> dict[str, any]:
+    """Set the Content-Length header of a body with known size"""
+    headers["Content-Length"] = size
+    return headers
 
 
 def stringify_headers(headers: dict[str, any]) -> str:
-    header_block = ""
-    for header in headers:
-        header_block += f"{header}: {headers[header]}{nlc}"
-    return header_block
+    return "".join([f"{name}: {value}{nlc}" for name, value in headers.items()])
 
 
 def map_status(status: int) -> str:
-    if status == 200:
-        return "200 Success"
-    if status == 304:
-        return "304 Not Modified"
-    if status == 400:
-        return "400 Bad Request"
-    if status == 404:
-        return "404 Not Found"
-    if status == 405:
-        return "405 Method Not Allowed"
-    if status == 500:
-        return "500 Server Error"
+    reason = status_reasons.get(status)
+    if reason is None:
+        return f"{status} Unmapped status"
+    return f"{status} {reason}"
+
 
-    return f"{status} Unmapped status"
+def status_line(status: int) -> bytes:
+    """Encoded response line for a status, prebuilt for all known statuses"""
+    line = status_lines.get(status)
+    if line is None:
+        line = to_bytes(f"HTTP/1.1 {map_status(status)}{nlc}")
+    return line
 
 
-def validate_request_headers(headers: dict[str, str]) -> bool:
-    """Check whether all required request headers are present"""
-    if "Host" not in headers:
+def validate_request_headers(headers: dict[str, str], version: str = "HTTP/1.1") -> bool:
+    """Check whether all required request headers are present, HTTP/1.0 does not require Host"""
+    if "Host" not in headers and version != "HTTP/1.0":
         return False
     return True
 
 
-def extract_request_line(request: str) -> (str, str, str, str):
-    """Extract and split request line from request"""
-    first_line_end = request.find(nlc)
-    first_line = request[:first_line_end]
-    [method, uri, version] = first_line.split(" ")
-    return method, uri, version, request[first_line_end + 2:]
-
-
 def handle_head_request(uri: str, request_headers: dict[str, str]) -> (int, dict[str, str], bytes):
     """Handle HEAD request and return response (basically equal to GET handling but without body in the response)"""
     logging.debug("Handling HEAD request")
-    if not is_found(uri):
+    cached = find_file(uri)
+    if cached is None:
         return 404, not_found_headers(), None
-    if not is_modified(uri, request_headers):
-        return 304, not_modified_headers(), None
-    headers = generic_headers(uri)
-    headers["Content-Length"] = get_size(uri)
+    if accepts_compressed(cached, request_headers):
+        status, headers, _ = compressed_response(cached, request_headers, False)
+        return status, headers, None
+    if not is_modified(cached, request_headers):
+        return not_modified_response(cached)
+    headers = file_headers(cached)
     return 200, headers, None
 
 
-def handle_get_request(uri: str, request_headers: dict[str, str]) -> (int, dict[str, str], bytes):
+def handle_get_request(uri: str, request_headers: dict[str, str]) -> (int, dict[str, str], bytes | BinaryIO):
     """Handle GET request and return response"""
     logging.debug("Handling GET request")
-    if not is_found(uri):
+    cached = find_file(uri)
+    if cached is None:
         return not_found_response()
-    if not is_modified(uri, request_headers):
-        return not_modified_response()
-    headers = generic_headers(uri)
-    body = get_body(uri)
-    return 200, headers, body
+    if accepts_compressed(cached, request_headers):
+        return compressed_response(cached, request_headers, True)
+    if not is_modified(cached, request_headers):
+        return not_modified_response(cached)
+    headers = file_headers(cached)
+    ranges = requested_ranges(cached, request_headers)
+    if ranges is None:
+        return 200, headers, get_body(cached)
+    if not ranges:
+        return range_not_satisfiable_response(cached)
+    return partial_content_response(cached, headers, ranges)
+
+
+def accepts_compressed(cached: CachedFile, request_headers: dict[str, str]) -> bool:
+    """Check whether a gzip encoded variant should be sent, range requests are always answered unencoded"""
+    return (is_compressible(cached) and 'Range' not in request_headers
+            and accepts_gzip(request_headers.get('Accept-Encoding', "")))
+
+
+def is_compressible(cached: CachedFile) -> bool:
+    """Check whether a file is large enough and of a media type that compresses well"""
+    return cached.size >= compression_min_size and (cached.media_type.startswith("text/")
+                                                    or cached.media_type in compressible_media_types)
+
+
+@lru_cache(maxsize=256)
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Check whether an Accept-Encoding header allows gzip, directly or through a wildcard"""
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, _, parameters = coding.partition(";")
+        quality = 1.0
+        parameter, _, value = parameters.partition("=")
+        if parameter.strip().lower() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+    return qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0))) > 0
+
+
+def compressed_response(cached: CachedFile, request_headers: dict[str, str],
+                        send_body: bool) -> (int, dict[str, any], ResponseBody):
+    """Serve the gzip encoded variant of a file, from a .gz sibling at least as new or compressed on the fly.
+    Without send_body the headers are those a GET would get, including the length of a compressed cached body"""
+    sibling = file_cache.get(cached.path + ".gz") if file_index.contains(cached.path + ".gz") else None
+    if sibling is not None and sibling.mtime_ns < cached.mtime_ns:
+        sibling = None
+    etag = variant_etag((sibling or cached).etag, "gzip")
+    if not is_modified(cached, request_headers, etag):
+        status, headers, body = not_modified_response(cached)
+        headers["ETag"] = etag
+        return status, headers, body
+    headers = file_headers(cached)
+    headers["ETag"] = etag
+    headers["Content-Encoding"] = "gzip"
+    if sibling is not None:
+        headers["Content-Length"] = sibling.size
+        return 200, headers, get_body(sibling) if send_body else None
+    key = (cached.path, cached.inode, cached.mtime_ns, "gzip")
+    compressed = compressed_cache.get(key)
+    if compressed is None and cached.body is not None:
+        compressed = gzip_compress(cached.body)
+        if len(compressed) <= compressed_cache_max_file_size:
+            compressed_cache.store(key, compressed)
+    if compressed is not None:
+        headers["Content-Length"] = len(compressed)
+        return 200, headers, compressed if send_body else None
+    del headers["Content-Length"]
+    if send_body:
+        return 200, headers, iter_compressed(cached, key)
+    headers["Transfer-Encoding"] = "chunked"
+    return 200, headers, None
 
 
-def handle_put_request(uri: str, body: str) -> (int, dict[str, str], bytes):
-    """Handle PUT request and return response"""
+def variant_etag(etag: str, encoding: str) -> str:
+    """Entity tag of an encoded variant, distinct from the unencoded one as strong validators must be"""
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def gzip_compress(data: bytes) -> bytes:
+    """Compress a body into the gzip format"""
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_compressed(cached: CachedFile, key: tuple) -> Iterator[bytes]:
+    """Compress a file chunk by chunk while it is sent, keeping the result for later requests if it is small"""
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 31)
+    kept = bytearray()
+    with open(cached.path, 'rb') as file:
+        keep = cached.matches(os.fstat(file.fileno()))
+        while data := file.read(response_chunk_size):
+            chunk = compressor.compress(data)
+            if keep and chunk:
+                kept += chunk
+                keep = len(kept) <= compressed_cache_max_file_size
+            if chunk:
+                yield chunk
+    chunk = compressor.flush()
+    yield chunk
+    if keep and len(kept) + len(chunk) <= compressed_cache_max_file_size:
+        compressed_cache.store(key, bytes(kept + chunk))
+
+
+def requested_ranges(cached: CachedFile, request_headers: dict[str, str]) -> list[tuple[int, int]] | None:
+    """Byte ranges to send instead of the whole file, None when the Range header is absent, invalid or stale"""
+    if 'Range' not in request_headers:
+        return None
+    if 'If-Range' in request_headers and request_headers['If-Range'] not in (cached.etag, cached.last_modified):
+        logging.debug("If-Range validator does not match, sending the whole file")
+        return None
+    return parse_range(request_headers['Range'], cached.size)
+
+
+def parse_range(value: str, size: int) -> list[tuple[int, int]] | None:
+    """Satisfiable ranges of a bytes Range header as inclusive (first, last) offsets, None if it is invalid"""
+    unit, _, specs = value.partition("=")
+    specs = specs.split(",")
+    if unit.strip().lower() != "bytes" or len(specs) > max_ranges:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition("-")
+        digits = first + last
+        if not dash or not (digits.isascii() and digits.isdigit()):
+            return None
+        if not first:
+            first, last = max(size - int(last), 0), size - 1 if int(last) else -1
+        elif last and int(last) < int(first):
+            return None
+        else:
+            first, last = int(first), min(int(last), size - 1) if last else size - 1
+        if first <= last:
+            ranges.append((first, last))
+    return ranges
+
+
+def partial_content_response(cached: CachedFile, headers: dict[str, any],
+                             ranges: list[tuple[int, int]]) -> (int, dict[str, any], ResponseBody):
+    """Create a 206 Partial Content message with one range or a multipart/byteranges body"""
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        headers["Content-Range"] = f"bytes {first}-{last}/{cached.size}"
+        if cached.body is not None:
+            return 206, headers, cached.body[first:last + 1]
+        return 206, headers, FilePart(open(cached.path, 'rb'), first, last - first + 1)
+    boundary = os.urandom(12).hex()
+    headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    del headers["Content-Length"]
+    parts = [(to_bytes(f"{nlc if index else ''}--{boundary}{nlc}Content-Type: {cached.media_type}{nlc}"
+                       f"Content-Range: bytes {first}-{last}/{cached.size}{nlc}{nlc}"), first, last - first + 1)
+             for index, (first, last) in enumerate(ranges)]
+    closing = to_bytes(f"{nlc}--{boundary}--{nlc}")
+    if cached.body is not None:
+        body = b"".join(head + cached.body[offset:offset + size] for head, offset, size in parts) + closing
+        return 206, headers, body
+    return 206, headers, iter_file_ranges(cached.path, parts, closing)
+
+
+def iter_file_ranges(path: str, parts: list[tuple[bytes, int, int]], closing: bytes) -> Iterator[bytes]:
+    """Multipart body of ranges of a file, read with pread so nothing outside the ranges is read"""
+    with open(path, 'rb') as file:
+        for head, offset, size in parts:
+            yield head
+            part = FilePart(file, offset, size)
+            while data := part.read(response_chunk_size):
+                yield data
+            if part.size:
+                raise OSError("File ended before its announced range")
+    yield closing
+
+
+def handle_put_request(uri: str, body_file: BinaryIO) -> (int, dict[str, str], bytes):
+    """Handle PUT request by atomically moving the spooled body into place and return response"""
     logging.debug("Handling PUT request")
-    created = not os.path.isfile(map_uri(uri))
-    new_fd = open(map_uri(uri), 'w')
-    new_fd.write(body)
-    new_fd.close()
+    path = map_uri(uri)
+    created = file_writer.replace(body_file, path)
+    file_cache.invalidate(path)
+    file_index.add(path)
     if created:
         status = 201
     else:
@@ -235,16 +1879,38 @@ def handle_put_request(uri: str, body: str) -> (int, dict[str, str], bytes):
     return status, headers, None
 
 
-def handle_post_request(uri: str, body: str) -> (int, dict[str, str], bytes):
-    """Handle POST request and return response"""
+def handle_post_request(uri: str, body_file: BinaryIO) -> (int, dict[str, str], bytes):
+    """Handle POST request by appending the spooled body to the target once the file writer committed it"""
     logging.debug("Handling POST request")
-    fd = open(map_uri(uri), 'a')
-    fd.write(body)
-    fd.close()
+    path = map_uri(uri)
+    file_writer.append(path, body_file)
+    file_cache.invalidate(path)
+    file_index.add(path)
     headers = put_or_post_headers(uri)
     return 200, headers, None
 
 
+def error_response(status: int) -> (int, dict[str, any], bytes):
+    """Create the standard message for an error status"""
+    if status == 400:
+        return bad_request_response()
+    if status == 404:
+        return not_found_response()
+    if status == 405:
+        return method_not_allowed_response()
+    if status == 408:
+        return request_timeout_response()
+    if status == 413:
+        return payload_too_large_response()
+    if status == 414:
+        return uri_too_long_response()
+    if status == 431:
+        return header_fields_too_large_response()
+    if status == 503:
+        return service_unavailable_response()
+    return 500, server_error_headers(), status_code_body(500)
+
+
 def bad_request_response() -> (int, dict[str, str], bytes):
     """Create a standard 400 Bad Request message"""
     header = bad_request_headers()
@@ -266,11 +1932,53 @@ def not_found_response() -> (int, dict[str, any], bytes):
     return 404, headers, body
 
 
-def not_modified_response() -> (int, dict[str, any], bytes):
-    """Create a standard 304 Not Modified message"""
-    headers = not_modified_headers()
-    body = status_code_body(304)
-    return 304, headers, body
+def not_modified_response(cached: CachedFile) -> (int, dict[str, any], None):
+    """Create a 304 Not Modified message, which never has a body"""
+    headers = not_modified_headers(cached)
+    return 304, headers, None
+
+
+def request_timeout_response() -> (int, dict[str, any], bytes):
+    """Create a standard 408 Request Timeout message"""
+    headers = generic_headers("/408_request_timeout.html")
+    body = status_code_body(408)
+    return 408, headers, body
+
+
+def payload_too_large_response() -> (int, dict[str, any], bytes):
+    """Create a standard 413 Payload Too Large message"""
+    headers = payload_too_large_headers()
+    body = status_code_body(413)
+    return 413, headers, body
+
+
+def uri_too_long_response() -> (int, dict[str, any], bytes):
+    """Create a standard 414 URI Too Long message"""
+    headers = closing_error_headers("/414_uri_too_long.html")
+    body = status_code_body(414)
+    return 414, headers, body
+
+
+def header_fields_too_large_response() -> (int, dict[str, any], bytes):
+    """Create a standard 431 Request Header Fields Too Large message"""
+    headers = closing_error_headers("/431_request_header_fields_too_large.html")
+    body = status_code_body(431)
+    return 431, headers, body
+
+
+def range_not_satisfiable_response(cached: CachedFile) -> (int, dict[str, any], bytes):
+    """Create a standard 416 Range Not Satisfiable message"""
+    headers = generic_headers("/416_range_not_satisfiable.html")
+    headers["Content-Range"] = f"bytes */{cached.size}"
+    body = status_code_body(416)
+    return 416, headers, body
+
+
+def service_unavailable_response() -> (int, dict[str, any], bytes):
+    """Create a standard 503 Service Unavailable message"""
+    headers = service_unavailable_headers()
+    body = status_code_body(503)
+    return 503, headers, body
 
 
 def bad_request_headers() -> dict[str, any]:
@@ -290,9 +1998,16 @@ def not_found_headers() -> dict[str, any]:
     return generic_headers("/404_not_found.html")
 
 
-def not_modified_headers() -> dict[str, any]:
-    """Create a standard 304 Not Modified header"""
-    return generic_headers("/304_not_modified.html")
+def not_modified_headers(cached: CachedFile) -> dict[str, any]:
+    """Create a 304 Not Modified header with the validators and caching policy of the file"""
+    headers = dict()
+    headers["Date"] = current_date()
+    headers["ETag"] = cached.etag
+    headers["Last-Modified"] = cached.last_modified
+    headers["Cache-Control"] = map_cache_control(cached.path)
+    if is_compressible(cached):
+        headers["Vary"] = "Accept-Encoding"
+    return headers
 
 
 def put_or_post_headers(uri: str) -> dict[str, any]:
@@ -301,6 +2016,27 @@ def put_or_post_headers(uri: str) -> dict[str, any]:
     headers = dict()
     headers["Date"] = date
     headers["Content-Location"] = uri
+    headers["Content-Length"] = 0
+    return headers
+
+
+def payload_too_large_headers() -> dict[str, any]:
+    """Create header for payload too large message"""
+    return closing_error_headers("/413_payload_too_large.html")
+
+
+def closing_error_headers(uri: str) -> dict[str, any]:
+    """Create header for an error message after which the rest of the request is not read"""
+    headers = generic_headers(uri)
+    headers["Connection"] = "close"
+    return headers
+
+
+def service_unavailable_headers() -> dict[str, any]:
+    """Create header for service unavailable message"""
+    headers = generic_headers("/503_service_unavailable.html")
+    headers["Retry-After"] = 1
+    headers["Connection"] = "close"
     return headers
 
 
@@ -321,82 +2057,329 @@ def generic_headers(uri: str) -> dict[str, any]:
     return headers
 
 
-def get_body(uri) -> bytes:
-    return get_file_content(uri)
+def file_headers(cached: CachedFile) -> dict[str, any]:
+    """Create a success header from the prebuilt headers of a cached file"""
+    headers = dict()
+    headers["Date"] = current_date()
+    headers.update(cached.headers)
+    headers["Cache-Control"] = map_cache_control(cached.path)
+    if is_compressible(cached):
+        headers["Vary"] = "Accept-Encoding"
+    return headers
+
+
+def get_body(cached: CachedFile) -> bytes | BinaryIO:
+    """Body of a cached file, large files are opened so their content can be streamed to the client"""
+    if cached.body is not None:
+        return cached.body
+    return open(cached.path, 'rb')
 
 
 def status_code_body(number) -> bytes:
     """Create status code based body"""
-    if number == 304:
-        body = get_file_content("/304_not_modified.html")
-    elif number == 400:
-        body = get_file_content("/400_bad_request.html")
+    if number == 400:
+        body = cached_file_content("/400_bad_request.html")
     elif number == 404:
-        body = get_file_content("/404_not_found.html")
+        body = cached_file_content("/404_not_found.html")
     elif number == 405:
-        body = get_file_content("/405_method_not_allowed.html")
+        body = cached_file_content("/405_method_not_allowed.html")
+    elif number == 408:
+        body = cached_file_content("/408_request_timeout.html")
+    elif number == 413:
+        body = cached_file_content("/413_payload_too_large.html")
+    elif number == 414:
+        body = cached_file_content("/414_uri_too_long.html")
+    elif number == 431:
+        body = cached_file_content("/431_request_header_fields_too_large.html")
+    elif number == 416:
+        body = cached_file_content("/416_range_not_satisfiable.html")
+    elif number == 503:
+        body = cached_file_content("/503_service_unavailable.html")
     else:
-        body = get_file_content("/500_server_error.html")
+        body = cached_file_content("/500_server_error.html")
     return body
 
 
-def is_modified(uri: str, request_headers: dict[str, str]) -> bool:
-    """Check whether the resource on a URI has been modified"""
+def is_modified(cached: CachedFile, request_headers: dict[str, str], etag: str | None = None) -> bool:
+    """Check the client's copy against a cached file, with If-None-Match taking precedence over If-Modified-Since"""
+    if 'If-None-Match' in request_headers:
+        return not etag_matches(request_headers['If-None-Match'], etag or cached.etag)
     if 'If-Modified-Since' not in request_headers:
         logging.debug("If-Modified-Since header not present, continuing flow as if modified")
         return True
-    modified_seconds = os.path.getmtime(map_uri(uri))
-    file_modified = datetime.fromtimestamp(modified_seconds)
-    if_modified_since = datetime.strptime(request_headers['If-Modified-Since'], "%a, %d %b %Y %H:%M:%S %Z")
-    logging.debug(f"Requested resource {uri} was {'' if file_modified > if_modified_since else 'not'} modified")
-    return file_modified > if_modified_since
+    if_modified_since = parse_http_date(request_headers['If-Modified-Since'])
+    if if_modified_since is None:
+        logging.debug("Ignoring invalid If-Modified-Since date")
+        return True
+    modified = int(cached.mtime) > if_modified_since
+    logging.debug("Requested resource %s was %smodified", cached.path, "" if modified else "not ")
+    return modified
 
 
-def current_date() -> str:
-    """Returns formatted current date"""
-    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time()))
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an entity tag against the list in an If-None-Match header"""
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
+
 
+@lru_cache(maxsize=1024)
+def parse_http_date(value: str) -> int | None:
+    """Seconds since the epoch of an HTTP date in any of its three formats, None if it is invalid"""
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
 
-def get_size(uri: str) -> int:
-    """Returns size of file"""
-    return os.path.getsize(map_uri(uri))
+
+def current_date() -> str:
+    """Returns formatted current date, only formatting it again once the second changed"""
+    global date_cache
+    second = int(time.time())
+    if date_cache[0] != second:
+        date_cache = (second, time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(second)))
+    return date_cache[1]
 
 
 def map_media_type(uri: str) -> str:
-    """Map file to correct media type"""
-    _, extension = os.path.splitext(uri)
-    logging.debug(f"Found extension: {extension}")
-    if extension == '.html':
-        return 'text/html'
-    if extension == '.jpg':
-        return 'image/jpg'
-    if extension == '.pdf':
-        return 'text/pdf'
-
-
-def is_found(uri: str) -> bool:
-    """Check whether a file exists for the given uri"""
-    if os.path.isfile(map_uri(uri)):
-        logging.debug(f"Requested resource {uri} found")
-        return True
+    """Map file to correct media type based on its extension"""
+    dot = uri.rfind(".")
+    if dot == -1 or "/" in uri[dot:]:
+        return default_media_type
+    return media_types.get(uri[dot:].lower(), default_media_type)
+
+
+def map_cache_control(path: str) -> str:
+    """Cache-Control policy for a file based on its extension"""
+    dot = path.rfind(".")
+    if dot == -1 or "/" in path[dot:]:
+        return default_cache_control
+    return cache_control_policies.get(path[dot:].lower(), default_cache_control)
+
+
+def find_file(uri: str) -> CachedFile | None:
+    """Look up the file for the given uri in the file cache, None if the directory index does not know it"""
+    path = file_index.lookup(map_uri(uri))
+    cached = file_cache.get(path) if path is not None else None
+    if cached is not None:
+        logging.debug("Requested resource %s found", uri)
     else:
-        logging.debug(f"Requested resource {uri} not found")
-        return False
+        logging.debug("Requested resource %s not found", uri)
+    return cached
 
 
 def map_uri(uri: str) -> str:
-    """Maps a URI to its server configured location"""
-    return f"server_files{uri}"
+    """Maps a URI to its location below the document root"""
+    return document_root + normalize_uri_path(uri)
+
+
+@lru_cache(maxsize=4096)
+def normalize_uri_path(uri: str) -> str:
+    """Percent decoded path of a URI without query and dot segments, HttpError 400 if it escapes the root"""
+    if not uri.startswith("/"):
+        parts = urlsplit(uri)
+        if parts.scheme not in ("http", "https"):
+            raise HttpError(400, f"Unsupported request target: {uri!r}")
+        uri = parts.path or "/"
+    path = unquote(uri.split("?", 1)[0].split("#", 1)[0])
+    if "\0" in path:
+        raise HttpError(400, "NUL byte in request path")
+    segments = []
+    for segment in path.split("/"):
+        if segment == "..":
+            if not segments:
+                raise HttpError(400, f"Request path escapes the document root: {uri!r}")
+            segments.pop()
+        elif segment and segment != ".":
+            segments.append(segment)
+    return "/" + "/".join(segments)
 
 
 def get_file_content(uri: str) -> bytes:
-    fd = open(map_uri(uri), 'rb')
-    return fd.read()
+    with open(map_uri(uri), 'rb') as fd:
+        return fd.read()
+
+
+def cached_file_content(uri: str) -> bytes:
+    """Content of a file, served from the file cache when it fits in there"""
+    cached = file_cache.get(map_uri(uri))
+    if cached is not None and cached.body is not None:
+        return cached.body
+    return get_file_content(uri)
 
 
 def validate_version(version: str) -> bool:
-    """Validates version. Only HTTP/1.1 supported"""
-    return "HTTP/1.1" == version
+    """Validates version. HTTP/1.1 and HTTP/1.0 are supported"""
+    return version in supported_versions
+
 
+file_cache = FileCache(file_cache_max_bytes, file_cache_max_file_size, file_cache_revalidate_interval,
+                       map_media_type, etag_content_hash)
+file_index = DirectoryIndex(document_root, directory_rescan_interval, index_files, upload_prefix)
+compressed_cache = VariantCache(compressed_cache_max_bytes)
+file_writer = FileWriter(fsync_policy, fsync_interval, max_open_append_files)
+lifecycle = Lifecycle()
 
-start_server()
+
+def config_arguments(parser: argparse.ArgumentParser, path: str) -> list[str]:
+    """Command line arguments equivalent to a TOML file whose keys are long option names, e.g. keep-alive-timeout = 2"""
+    try:
+        with open(path, "rb") as config_file:
+            config = tomllib.load(config_file)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        parser.error(f"reading the configuration {path} failed: {e}")
+    arguments = []
+    for key, value in config.items():
+        option = "--" + key.replace("_", "-")
+        if option not in parser._option_string_actions or option == "--config":
+            parser.error(f"unknown option {key} in {path}")
+        if value is True:
+            arguments.append(option)
+        elif value is False:
+            if "--no-" + option[2:] in parser._option_string_actions:
+                arguments.append("--no-" + option[2:])
+        else:
+            for item in value if isinstance(value, list) else [value]:
+                arguments += [option, str(item)]
+    return arguments
+
+
+def main():
+    """Parse command line options and start the server"""
+    global concurrency_model, listen_backlog, worker_pool_size, worker_queue_size, worker_processes
+    global max_request_body_size, response_chunk_size, keep_alive_timeout, max_keep_alive_requests
+    global default_cache_control, compression_level, access_log_path, metrics_path, profile_path
+    global max_buffer_size, tcp_no_delay, tcp_cork, tcp_defer_accept, tcp_fast_open
+    global socket_send_buffer, socket_receive_buffer, host_port, bind_address, document_root, drain_timeout
+    global max_request_line_size, max_header_count, max_header_size
+    parser = argparse.ArgumentParser(description="HTTP workshop server")
+    parser.add_argument("--config", metavar="PATH",
+                        help="TOML file of options named like the long options, the command line takes precedence")
+    parser.add_argument("--port", type=int, default=host_port, help="port to listen on")
+    parser.add_argument("--bind", default=bind_address, metavar="ADDRESS",
+                        help="IPv4 address to listen on, all interfaces if omitted")
+    parser.add_argument("--document-root", default=document_root, metavar="PATH", help="directory of the served files")
+    parser.add_argument("--mode", choices=concurrency_models, default=concurrency_model,
+                        help="threaded: one thread per connection, event_loop: single threaded selectors loop, "
+                             "pool: fixed size worker thread pool, asyncio: asyncio tasks with async handler support")
+    parser.add_argument("--backlog", type=int, default=listen_backlog, help="listen() backlog")
+    parser.add_argument("--workers", type=int, default=worker_pool_size, help="worker threads in pool mode")
+    parser.add_argument("--queue-size", type=int, default=worker_queue_size,
+                        help="accepted connections waiting for a worker before answering 503 in pool mode")
+    parser.add_argument("--cache-size", type=int, default=file_cache_max_bytes,
+                        help="byte budget of the in-memory file cache")
+    parser.add_argument("--max-body-size", type=int, default=max_request_body_size,
+                        help="largest accepted request body in bytes, larger ones are answered with 413")
+    parser.add_argument("--max-request-line", type=int, default=max_request_line_size,
+                        help="longest accepted request line in bytes, longer ones are answered with 414")
+    parser.add_argument("--max-headers", type=int, default=max_header_count,
+                        help="most header fields accepted in a request, more are answered with 431")
+    parser.add_argument("--max-header-size", type=int, default=max_header_size,
+                        help="largest accepted request head in bytes, larger ones are answered with 431")
+    parser.add_argument("--chunk-size", type=int, default=response_chunk_size,
+                        help="bytes gathered per write when streaming chunked response bodies")
+    parser.add_argument("--keep-alive-timeout", type=float, default=keep_alive_timeout,
+                        help="seconds an idle persistent connection is kept open")
+    parser.add_argument("--max-keep-alive-requests", type=int, default=max_keep_alive_requests,
+                        help="requests served on one connection before it is closed")
+    parser.add_argument("--processes", type=int, default=worker_processes,
+                        help="number of pre-forked worker processes sharing the port, 0 to serve in this process")
+    parser.add_argument("--compression-level", type=int, choices=range(1, 10), default=compression_level,
+                        help="zlib level for gzip encoding compressible files on the fly")
+    parser.add_argument("--compressed-cache-size", type=int, default=compressed_cache_max_bytes,
+                        help="byte budget of the cache of gzip encoded files")
+    parser.add_argument("--etag-content-hash", action="store_true", default=etag_content_hash,
+                        help="derive entity tags from file content instead of inode, size and modification time")
+    parser.add_argument("--cache-control", default=default_cache_control,
+                        help="Cache-Control header of files without an extension specific policy")
+    parser.add_argument("--cache-control-policy", action="append", default=[], metavar="EXTENSION=VALUE",
+                        help="Cache-Control header of files with an extension, e.g. .css=max-age=3600")
+    parser.add_argument("--access-log", metavar="PATH",
+                        help="append a JSON line with the timing of every request to this file")
+    parser.add_argument("--metrics", nargs="?", const="/metrics", metavar="PATH",
+                        help="serve request counters and latency histograms at this path, /metrics if omitted; "
+                             "with --processes each worker reports its own, labelled with its pid")
+    parser.add_argument("--read-size", type=int, default=max_buffer_size,
+                        help="largest read from a connection, reads start small and grow while they fill up")
+    parser.add_argument("--tcp-nodelay", action=argparse.BooleanOptionalAction, default=tcp_no_delay,
+                        help="disable Nagle's algorithm on accepted connections")
+    parser.add_argument("--tcp-cork", action="store_true", default=tcp_cork,
+                        help="cork connections while sending a response head and file so that they share packets")
+    parser.add_argument("--tcp-defer-accept", type=float, default=tcp_defer_accept, metavar="SECONDS",
+                        help="only accept connections once they sent data or this many seconds passed")
+    parser.add_argument("--tcp-fast-open", type=int, default=tcp_fast_open, metavar="QUEUE",
+                        help="accept data in SYN packets for up to this many pending connections")
+    parser.add_argument("--send-buffer", type=int, default=socket_send_buffer,
+                        help="SO_SNDBUF of connections in bytes, kernel autotuning if omitted")
+    parser.add_argument("--receive-buffer", type=int, default=socket_receive_buffer,
+                        help="SO_RCVBUF of connections in bytes, kernel autotuning if omitted")
+    parser.add_argument("--rescan-interval", type=float, default=directory_rescan_interval,
+                        help="seconds between rescans of the document root for files created by other processes")
+    parser.add_argument("--profile-endpoint", nargs="?", const="/debug/profile", metavar="PATH",
+                        help="POST to this path samples the server stacks, GET returns them, /debug/profile if omitted")
+    parser.add_argument("--profile-dir", default=http_profiler.profile_directory,
+                        help="directory of the collapsed stack files written when profiling, e.g. after SIGUSR1")
+    parser.add_argument("--profile-seconds", type=float, default=http_profiler.profile_duration,
+                        help="seconds sampled per profile")
+    parser.add_argument("--fsync", choices=fsync_policies, default=fsync_policy,
+                        help="none: leave flushing writes to the kernel, interval: sync appended files at most once "
+                             "per --fsync-interval, always: sync every PUT and POST before answering")
+    parser.add_argument("--fsync-interval", type=float, default=fsync_interval,
+                        help="seconds between syncs of appended files with --fsync interval")
+    parser.add_argument("--drain-timeout", type=float, default=drain_timeout,
+                        help="seconds in-flight requests get to finish on SIGTERM or SIGHUP before connections are closed")
+    args = parser.parse_args()
+    if args.config:
+        args = parser.parse_args(config_arguments(parser, args.config) + sys.argv[1:])
+    if args.processes > 0 and not hasattr(os, "fork"):
+        parser.error("--processes requires a platform with os.fork")
+    for policy in args.cache_control_policy:
+        extension, separator, value = policy.partition("=")
+        if not separator or not extension.startswith("."):
+            parser.error(f"--cache-control-policy expects .EXTENSION=VALUE, got {policy}")
+        cache_control_policies[extension.lower()] = value
+    host_port = args.port
+    bind_address = args.bind
+    document_root = file_index.root = args.document_root
+    drain_timeout = args.drain_timeout
+    concurrency_model = args.mode
+    listen_backlog = args.backlog
+    worker_pool_size = args.workers
+    worker_queue_size = args.queue_size
+    worker_processes = args.processes
+    file_cache.max_bytes = args.cache_size
+    file_cache.hash_content = args.etag_content_hash
+    file_index.rescan_interval = args.rescan_interval
+    max_buffer_size = args.read_size
+    tcp_no_delay = args.tcp_nodelay
+    tcp_cork = args.tcp_cork
+    tcp_defer_accept = args.tcp_defer_accept
+    tcp_fast_open = args.tcp_fast_open
+    socket_send_buffer = args.send_buffer
+    socket_receive_buffer = args.receive_buffer
+    default_cache_control = args.cache_control
+    compression_level = args.compression_level
+    compressed_cache.max_bytes = args.compressed_cache_size
+    file_writer.fsync_policy = args.fsync
+    file_writer.fsync_interval = args.fsync_interval
+    max_request_body_size = args.max_body_size
+    max_request_line_size = args.max_request_line
+    max_header_count = args.max_headers
+    max_header_size = args.max_header_size
+    response_chunk_size = args.chunk_size
+    keep_alive_timeout = args.keep_alive_timeout
+    max_keep_alive_requests = args.max_keep_alive_requests
+    access_log_path = args.access_log
+    metrics_path = args.metrics
+    profile_path = args.profile_endpoint
+    http_profiler.profile_directory = args.profile_dir
+    http_profiler.profile_duration = args.profile_seconds
+    start_server()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import unittest
+
+from http_commons import HttpError, RequestParser
+
+
+class RequestParserTest(unittest.TestCase):
+    """Incremental request parsing"""
+
+    def test_requests_before_malformed_one_are_returned(self):
+        parser = RequestParser()
+        requests = parser.feed(b"GET /small.txt HTTP/1.1\r\nHost: localhost\r\n\r\nBAD\r\n\r\n")
+        self.assertEqual([(request.method, request.uri) for request in requests], [("GET", "/small.txt")])
+        with self.assertRaises(HttpError) as raised:
+            parser.raise_pending()
+        self.assertEqual(raised.exception.status, 400)
+        with self.assertRaises(HttpError):
+            parser.feed(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+
+    def test_chunked_body(self):
+        requests = RequestParser().feed(b"PUT /a HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n"
+                                        b"3;name=value\r\nabc\r\nA\r\n0123456789\r\n0\r\n\r\n")
+        self.assertEqual(bytes(requests[0].body), b"abc0123456789")
+
+    def test_chunk_size_must_be_hexadecimal_digits(self):
+        for size in (b"+3", b"-3", b"0x3", b"1_0", b" 3", b""):
+            with self.subTest(size=size), self.assertRaises(HttpError) as raised:
+                RequestParser().feed(b"PUT /a HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n"
+                                     + size + b"\r\nabc\r\n0\r\n\r\n")
+            self.assertEqual(raised.exception.status, 400)
+
+    def test_content_length_must_be_ascii_digits(self):
+        for length in (b"\xb2", b"-1", b"1 2", b""):
+            with self.subTest(length=length), self.assertRaises(HttpError) as raised:
+                RequestParser().feed(b"PUT /a HTTP/1.1\r\nHost: localhost\r\nContent-Length: " + length + b"\r\n\r\n")
+            self.assertEqual(raised.exception.status, 400)
+
+    def test_long_request_line_is_rejected_with_414(self):
+        for request in (b"GET /" + b"a" * 200 + b" HTTP/1.1\r\nHost: localhost\r\n\r\n", b"GET /" + b"a" * 200):
+            with self.subTest(complete=request.endswith(b"\r\n")), self.assertRaises(HttpError) as raised:
+                RequestParser(max_request_line=100, max_head=150).feed(request)
+            self.assertEqual(raised.exception.status, 414)
+
+    def test_large_head_is_rejected_with_431(self):
+        fields = b"".join(b"X-Field-%d: value\r\n" % index for index in range(20))
+        for request, limits in ((b"GET / HTTP/1.1\r\n" + fields + b"\r\n", {"max_head": 200}),
+                                (b"GET / HTTP/1.1\r\n" + fields, {"max_head": 200}),
+                                (b"GET / HTTP/1.1\r\n" + fields + b"\r\n", {"max_headers": 10})):
+            with self.subTest(limits=limits, complete=request.endswith(b"\r\n\r\n")), \
+                    self.assertRaises(HttpError) as raised:
+                RequestParser(**limits).feed(request)
+            self.assertEqual(raised.exception.status, 431)
+
+    def test_large_body_is_rejected_with_413(self):
+        for request in (b"PUT /a HTTP/1.1\r\nHost: localhost\r\nContent-Length: 101\r\n\r\n",
+                        b"PUT /a HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n"
+                        b"40\r\n" + b"x" * 64 + b"\r\n40\r\n"):
+            with self.subTest(chunked=b"chunked" in request), self.assertRaises(HttpError) as raised:
+                RequestParser(max_body_size=100).feed(request)
+            self.assertEqual(raised.exception.status, 413)
+
+    def test_transfer_encoding_with_content_length_is_rejected(self):
+        with self.assertRaises(HttpError) as raised:
+            RequestParser().feed(b"PUT /a HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n"
+                                 b"Content-Length: 5\r\n\r\n0\r\n\r\n")
+        self.assertEqual(raised.exception.status, 400)
+
+    def test_chunk_lines_without_line_ending_are_bounded(self):
+        head = b"PUT /a HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n"
+        for chunks, status in ((b"3;" + b"x" * 200, 400), (b"0\r\nX-Trailer: " + b"x" * 200, 431),
+                               (b"0\r\n" + b"X-Trailer: x\r\n" * 20, 431)):
+            parser = RequestParser(max_request_line=100, max_head=200)
+            with self.subTest(chunks=chunks[:16]), self.assertRaises(HttpError) as raised:
+                parser.feed(head)
+                parser.feed(chunks)
+            self.assertEqual(raised.exception.status, status)
+
+    def test_malformed_first_request_raises(self):
+        with self.assertRaises(HttpError) as raised:
+            RequestParser().feed(b"BAD\r\n\r\n")
+        self.assertEqual(raised.exception.status, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()